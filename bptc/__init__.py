@@ -4,8 +4,25 @@ import sys
 # PARAMETER
 C = 6  # How often a coin round occurs, e.g. 6 for every sixth round
 push_waiting_time_mu, push_waiting_time_sigma = 1, 0.02  # mean and standard deviation of push rate
+push_waiting_time_min, push_waiting_time_max = 0.25, 8  # bounds of the push interval (see GossipScheduler)
+push_fanout = 2  # members pushed to at once
+push_backlog_threshold = 20  # unordered events per member above which pushes are sent more often
 new_member_stake = 0  # the stake a new member gets
 new_member_account_balance = 10  # the initial balance of a new member
+signature_verification_processes = None  # processes verifying signatures in parallel (None: one per CPU, 1: no pool)
+signature_verification_pool_threshold = 64  # smaller batches of signatures are verified without the pool
+push_compression_min_size = 256  # smaller pushes are sent uncompressed
+push_lzma_min_size = 1048576  # bigger pushes are compressed with lzma instead of zlib (smaller, but much slower)
+push_max_message_length = 67108864  # bytes a received push may have - the connection is closed for longer ones
+push_max_decompressed_size = 134217728  # bytes a received push may decompress to - bigger ones are dropped
+push_queue_size = 32  # received pushes waiting to be processed (they are processed together) - more are dropped
+push_fragment_cache_size = 33554432  # bytes of serialized events kept for building pushes (least recently used are dropped)
+db_flush_interval = 5  # seconds between storing the changes of the hashgraph in the background
+db_flush_threshold = 1000  # changed events which are stored right away
+db_journal_mode = 'WAL'  # journal of the database (see SQLite's PRAGMA journal_mode)
+db_synchronous = 'NORMAL'  # how often the database waits for the disk: OFF, NORMAL or FULL (see PRAGMA synchronous)
+event_horizon_rounds = 50  # events ordered this many rounds ago are evicted and archived (see Hashgraph.prune())
+event_cache_size = 1000  # evicted events kept in memory after reading them again (least recently used are dropped)
 
 # listening interface information
 ip = None
@@ -156,10 +156,16 @@ class ConsoleApp(InteractiveShell):
         print('Balance: {} BPTC'.format(self.me.account_balance))
         print('Stake: {}'.format(self.me.stake))
         print()
-        print('{} events, {} confirmed'.format(len(self.hashgraph.lookup_table.keys()),
+        print('{} events, {} confirmed'.format(self.hashgraph.generation,
                                                len(self.hashgraph.ordered_events)))
         print('Last push sent: {}'.format(self.network.last_push_sent))
         print('Last push received: {}'.format(self.network.last_push_received))
+        print('Received events: {} ({} already known, {:.0%})'.format(self.network.received_events_count,
+                                                                  self.network.duplicate_events_count,
+                                                                  self.network.duplicate_events_rate))
+        print('Pushes waiting: {} ({} merged, {} dropped)'.format(self.network.push_queue_depth,
+                                                               self.network.merged_pushes_count,
+                                                               self.network.dropped_pushes_count))
 
     def cmd_send(self, args):
         # Stored as list if a member name contains spaces
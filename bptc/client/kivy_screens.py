@@ -199,7 +199,7 @@ class DebugScreen(KivyScreen):
         # endless loop for updating information displayed
         def update_statistics():
             self.ids.listening_interface_label.text = 'Listening interface: {}:{}'.format(bptc.ip, bptc.port)
-            self.ids.event_count_label.text = '{} events, {} confirmed'.format(len(self.hashgraph.lookup_table.keys()),
+            self.ids.event_count_label.text = '{} events, {} confirmed'.format(self.hashgraph.generation,
                                                                                len(self.hashgraph.ordered_events))
             self.ids.last_push_sent_label.text = 'Last push sent: {}'.format(self.network.last_push_sent)
             self.ids.last_push_received_label.text = 'Last push received: {}'.format(self.network.last_push_received)
@@ -1,12 +1,11 @@
 import bptc
-from bptc.data.event import Event, Fame
+from bptc.data.event import Event, Fame, isoformat_from_timestamp
 from bptc.data.member import Member
 from collections import defaultdict
-from typing import Set
+from typing import Set, List, Dict
 from datetime import datetime
 import math
-import dateutil.parser
-import time
+from array import array
 from statistics import median
 from bptc.utils.toposort import toposort
 
@@ -30,9 +29,9 @@ def divide_rounds(hashgraph, events):
         if event.parents.self_parent is None or event.round > hashgraph.lookup_table[event.parents.self_parent].round:
             hashgraph.witnesses[r][event.verify_key] = event.id
             event.is_witness = True
-
-        # DEBUG
-        event.processed_by_divideRounds = True
+            # The fame of pruned rounds was decided (see Hashgraph.prune())
+            if r not in hashgraph.rounds_with_decided_fame and r > hashgraph.pruned_round:
+                hashgraph.undecided_witnesses.add(event.id)
 
 
 def event_can_can_strongly_see_enough_round_r_witnesses(hashgraph, event: Event, r: int):
@@ -44,13 +43,28 @@ def event_can_can_strongly_see_enough_round_r_witnesses(hashgraph, event: Event,
 
 
 def get_members_with_strongly_seen_witnesses_for_round(hashgraph, event: Event, r: int):
-    members_on_paths = fast_get_members_on_paths_to_witnesses_for_round(hashgraph, event, r)
-    #old_members_on_paths = get_members_on_paths_to_witnesses_for_round(hashgraph, event, r)
+    # Heights are ambiguous for members who forked - fall back to walking the graph
+    if hashgraph.fork_blacklist:
+        return get_members_with_strongly_seen_witnesses_for_round_by_paths(hashgraph, event, r)
 
-    #same = len(members_on_paths) == len(old_members_on_paths) and all([len(s) == len(o_s) for s, o_s in zip(members_on_paths, old_members_on_paths)])
+    # Collect all members who's witnesses we can strongly see
+    # A member is on a path from the witness to the event if the event knows one of the member's events
+    # which is at least as high as the member's first descendant of the witness
+    # (First descendants grow while events are added in parallel - use a copy)
+    members_with_strongly_seen_witnesses = set()
+    for member_id, witness_id in hashgraph.witnesses[r].items():
+        first_descendants = hashgraph.lookup_table[witness_id].first_descendants.tolist()
+        stake_on_path = sum([hashgraph.known_members[hashgraph.member_ids[i]].stake
+                             for i, height in enumerate(first_descendants)
+                             if height >= 0 and get_height(event.last_ancestors, i) >= height])
+        if stake_on_path > hashgraph.supermajority_stake:
+            members_with_strongly_seen_witnesses.add(member_id)
+
+    return members_with_strongly_seen_witnesses
 
-    #if not same:
-    #    print("Fast member on paths was not equal!")
+
+def get_members_with_strongly_seen_witnesses_for_round_by_paths(hashgraph, event: Event, r: int):
+    members_on_paths = fast_get_members_on_paths_to_witnesses_for_round(hashgraph, event, r)
 
     # Collect all members who's witnesses we can strongly see
     members_with_strongly_seen_witnesses = set()
@@ -94,36 +108,31 @@ def get_members_on_paths_to_witnesses_for_round(hashgraph, start_event: Event, r
 
 
 def fast_get_members_on_paths_to_witnesses_for_round(hashgraph, start_event: Event, r: int):
-    # for every ancestor, the nodes that were visited to read it
-    members_on_paths = defaultdict(set)
-    members_on_paths[start_event.id].add(start_event.verify_key)
-    visited, queue = set(), [start_event]
-
-    while queue:
-        event = queue.pop(0)
+    # Collect all ancestors down to round r
+    visited, to_visit = {}, [start_event]
+    while to_visit:
+        event = to_visit.pop()
 
         # Stop once we reach the previous round
-        if event.id != start_event.id and event.round < r:
+        if event.id in visited or (event.id != start_event.id and event.round < r):
             continue
+        visited[event.id] = event
 
-        if event not in visited:
-            visited.add(event)
-
-            if event.parents.self_parent is not None:
-                self_parent = hashgraph.lookup_table[event.parents.self_parent]
-                if self_parent.verify_key not in hashgraph.fork_blacklist:
-                    members_on_paths[self_parent.id].add(self_parent.verify_key)
-                    members_on_paths[self_parent.id].add(event.verify_key)
-                    members_on_paths[self_parent.id] |= members_on_paths[event.id]
-                    queue.append(self_parent)
-
-            if event.parents.other_parent is not None:
-                other_parent = hashgraph.lookup_table[event.parents.other_parent]
-                if other_parent.verify_key not in hashgraph.fork_blacklist:
-                    members_on_paths[other_parent.id].add(other_parent.verify_key)
-                    members_on_paths[other_parent.id].add(event.verify_key)
-                    members_on_paths[other_parent.id] |= members_on_paths[event.id]
-                    queue.append(other_parent)
+        for parent_id in event.parents:
+            if parent_id is not None:
+                parent = hashgraph.lookup_table[parent_id]
+                if parent.verify_key not in hashgraph.fork_blacklist:
+                    to_visit.append(parent)
+
+    # for every ancestor, the nodes that were visited to read it
+    # Children are handled before their parents, so every path is complete once we reach an event
+    members_on_paths = defaultdict(set)
+    members_on_paths[start_event.id].add(start_event.verify_key)
+    for event in reversed(toposort(visited)):
+        for parent_id in event.parents:
+            if parent_id in visited:
+                members_on_paths[parent_id].add(visited[parent_id].verify_key)
+                members_on_paths[parent_id] |= members_on_paths[event.id]
 
     # Only witnesses are relevant
     result = defaultdict(set)
@@ -134,54 +143,139 @@ def fast_get_members_on_paths_to_witnesses_for_round(hashgraph, start_event: Eve
     return result
 
 
+def index_ancestry(hashgraph, event: Event) -> None:
+    """
+    Updates the ancestry index (last ancestors and first descendants per member) for a newly added event
+    :param hashgraph: The hashgraph containing the event and all of its ancestors
+    :param event: The event that was just added
+    :return: None
+    """
+    creator = hashgraph.member_index(event.verify_key)
+
+    # The latest known ancestors are the latest ancestors of both parents
+    # (Evicted parents have no ancestry vectors - their ancestors are too old to matter for the consensus)
+    last_ancestors = array('i')
+    for parent_id in event.parents:
+        if parent_id is not None:
+            parent_last_ancestors = hashgraph.lookup_table[parent_id].last_ancestors
+            if len(last_ancestors) == 0:
+                last_ancestors.extend(parent_last_ancestors)
+                continue
+            extend_vector(last_ancestors, len(parent_last_ancestors))
+            for i, height in enumerate(parent_last_ancestors):
+                if height > last_ancestors[i]:
+                    last_ancestors[i] = height
+    extend_vector(last_ancestors, creator + 1)
+    last_ancestors[creator] = event.height
+    event.last_ancestors = last_ancestors
+
+    # The event is the first descendant by its creator for all ancestors which don't have one yet
+    # If an event already has one, all of its ancestors have one as well
+    to_visit = [event]
+    while to_visit:
+        ancestor = to_visit.pop()
+        if get_height(ancestor.first_descendants, creator) >= 0:
+            continue
+        extend_vector(ancestor.first_descendants, creator + 1)
+        ancestor.first_descendants[creator] = event.height
+
+        # Evicted events were ordered long ago - their first descendants aren't needed any more
+        for parent_id in ancestor.parents:
+            if parent_id is not None and hashgraph.lookup_table.is_resident(parent_id):
+                to_visit.append(hashgraph.lookup_table[parent_id])
+
+
+def get_height(vector: array, member_index: int) -> int:
+    """
+    Returns the height stored for a member in an ancestry vector (last ancestors or first descendants)
+    :param vector: The vector
+    :param member_index: The index of the member, see Hashgraph.member_index()
+    :return: The height or -1 if there is none
+    """
+    return vector[member_index] if member_index < len(vector) else -1
+
+
+def extend_vector(vector: array, length: int) -> None:
+    """Makes an ancestry vector at least as long as the given length, filling it up with -1."""
+    if len(vector) < length:
+        vector.extend([-1] * (length - len(vector)))
+
+
 # DECIDE FAME
 
 def decide_fame(hashgraph):
-    for x_round in range(0, max(hashgraph.witnesses)+1):
-        # Skip this round if we already decided its fame completely
-        if x_round in hashgraph.rounds_with_decided_fame:
-            continue
-
-        x_events = {e: hashgraph.lookup_table[e] for e in hashgraph.witnesses[x_round].values()}
-        for x in toposort(x_events):
-            for y_round in range(x_round+1, max(hashgraph.witnesses)+1):
-                y_events = {e: hashgraph.lookup_table[e] for e in hashgraph.witnesses[y_round].values()}
-                for y in toposort(y_events):
-                    d = y.round - x.round
-
-                    if d == 1:
-                        # If there is only one round difference, just vote
-                        y.votes[x.id] = event_can_see_event(hashgraph, y, x)
-                        # print('{} votes {} on {}'.format(y.short_id, y.votes[x.id], x.short_id))
-                    else:
-                        # If there are multiple rounds difference, collect votes
-                        s = get_strongly_seen_witnesses_for_round(hashgraph, y, y.round-1)
-                        v, t = get_majority_vote_in_set_for_event(hashgraph, s, x)
-
-                        if d % bptc.C > 0:  # This is a normal round
-                            if t > hashgraph.supermajority_stake:  # If supermajority, then decide
-                                x.is_famous = v
-                                # print('{} fame decided: {}'.format(x.short_id, x.is_famous))
-                                y.votes[x.id] = v
-                                # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
-                                break
-                            else:  # Else, just vote
-                                y.votes[x.id] = v
-                                # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
-                        else:  # This is a coin round
-                            if t > hashgraph.supermajority_stake:  # If supermajority, then vote
-                                y.votes[x.id] = v
-                                # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
-                            else:  # Else, flip a coin
-                                y.votes[x.id] = decide_randomly_based_on_signature(y.signature)
-                                # print('{} randomly votes {} on {}'.format(y.short_id, y.votes[x.id], x.short_id))
-
-        # Check if round x was completely decided
+    if len(hashgraph.undecided_witnesses) == 0:
+        return
+
+    max_round = max(hashgraph.witnesses)
+    touched_rounds = set()
+
+    # Only witnesses with undecided fame are voted on - votes which were already cast stay valid
+    x_events = [hashgraph.lookup_table[e] for e in hashgraph.undecided_witnesses]
+    for x in sorted(x_events, key=lambda e: e.round):
+        touched_rounds.add(x.round)
+        for y_round in range(x.round+1, max_round+1):
+            for y_id in hashgraph.witnesses[y_round].values():
+                y = hashgraph.lookup_table[y_id]
+
+                # Skip witnesses which already voted
+                if x.id in y.votes:
+                    continue
+
+                d = y.round - x.round
+
+                if d == 1:
+                    # If there is only one round difference, just vote
+                    y.votes[x.id] = event_can_see_event(hashgraph, y, x)
+                    # print('{} votes {} on {}'.format(y.short_id, y.votes[x.id], x.short_id))
+                else:
+                    # If there are multiple rounds difference, collect votes
+                    s = get_cached_strongly_seen_witnesses(hashgraph, y)
+                    v, t = get_majority_vote_in_set_for_event(hashgraph, s, x)
+
+                    if d % bptc.C > 0:  # This is a normal round
+                        if t > hashgraph.supermajority_stake:  # If supermajority, then decide
+                            x.is_famous = v
+                            # print('{} fame decided: {}'.format(x.short_id, x.is_famous))
+                            y.votes[x.id] = v
+                            # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
+                            break
+                        else:  # Else, just vote
+                            y.votes[x.id] = v
+                            # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
+                    else:  # This is a coin round
+                        if t > hashgraph.supermajority_stake:  # If supermajority, then vote
+                            y.votes[x.id] = v
+                            # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
+                        else:  # Else, flip a coin
+                            y.votes[x.id] = decide_randomly_based_on_signature(y.signature)
+                            # print('{} randomly votes {} on {}'.format(y.short_id, y.votes[x.id], x.short_id))
+
+            # Stop voting once the fame is decided
+            if x.is_famous != Fame.UNDECIDED:
+                hashgraph.undecided_witnesses.discard(x.id)
+                break
+
+    # Check if the rounds were completely decided
+    for x_round in sorted(touched_rounds):
         if all([hashgraph.lookup_table[event_id].is_famous != Fame.UNDECIDED for event_id in hashgraph.witnesses[x_round].values()]):
             hashgraph.rounds_with_decided_fame.add(x_round)
             bptc.logger.debug("Fame is completely decided for round {}".format(x_round))
 
 
+def get_cached_strongly_seen_witnesses(hashgraph, y: Event) -> Set[str]:
+    """
+    Returns the witnesses of the previous round which a witness strongly sees
+    They are ancestors of the witness, so the result never changes once the witness is known
+    :param hashgraph: The hashgraph
+    :param y: The witness
+    :return: Set of witness hashes
+    """
+    if y.id not in hashgraph.strongly_seen_witnesses:
+        hashgraph.strongly_seen_witnesses[y.id] = get_strongly_seen_witnesses_for_round(hashgraph, y, y.round-1)
+    return hashgraph.strongly_seen_witnesses[y.id]
+
+
 def get_strongly_seen_witnesses_for_round(hashgraph, event: Event, r: int) -> Set[str]:
     members_with_strongly_seen_witnesses = get_members_with_strongly_seen_witnesses_for_round(hashgraph, event, r)
     return set([hashgraph.witnesses[r][m] for m in members_with_strongly_seen_witnesses])
@@ -218,33 +312,18 @@ def event_can_see_event(hg, event_1: Event, event_2: Event) -> bool:
     :return:
     """
 
-    # Only calculate if the answer is not already cached
-    if event_2.id in event_1.can_see_cache:
-        return event_1.can_see_cache[event_2.id]
-    else:
-        # Check for fork
-        if event_2.verify_key in hg.fork_blacklist:
-            event_1.can_see_cache[event_2.id] = False
-            return False
+    # Check for fork
+    if event_2.verify_key in hg.fork_blacklist:
+        return False
 
-        if event_1.parents.self_parent == event_2.id or event_1.parents.other_parent == event_2.id:
-            event_1.can_see_cache[event_2.id] = True
-            return True
+    # An event doesn't see itself
+    if event_1.id == event_2.id:
+        return False
 
-        can_see = False
-
-        if event_1.parents.self_parent is not None:
-            can_see = event_can_see_event(hg, hg.lookup_table[event_1.parents.self_parent], event_2)
-
-        if can_see:
-            event_1.can_see_cache[event_2.id] = True
-            return True
-
-        if event_1.parents.other_parent is not None:
-            can_see = event_can_see_event(hg, hg.lookup_table[event_1.parents.other_parent], event_2)
-
-        event_1.can_see_cache[event_2.id] = can_see
-        return can_see
+    # The events of a member who didn't fork form a single chain - event 1 sees event 2
+    # if it knows an event by the same member which is at least as high
+    member_index = hg.member_indices.get(event_2.verify_key)
+    return member_index is not None and get_height(event_1.last_ancestors, member_index) >= event_2.height
 
 
 def decide_randomly_based_on_signature(signature: str) -> bool:
@@ -256,76 +335,133 @@ def decide_randomly_based_on_signature(signature: str) -> bool:
 # FIND ORDER
 
 def find_order(hg):
-    decided_events = set()
-
-    for x_id in hg.unordered_events:
-        x = hg.lookup_table[x_id]
-        # We want to find the order of x
-        # Look for a round in which all famous witnesses see r
-        for r in range(x.round+1, max(hg.witnesses)+1):
-            # Only use rounds that have fully decided fame
-            if r not in hg.rounds_with_decided_fame:
+    # Rounds are used in ascending order as soon as their fame is decided. Every event is received
+    # by the first round in which all famous witnesses see it.
+    while hg.next_round_to_order in hg.rounds_with_decided_fame:
+        r = hg.next_round_to_order
+        hg.next_round_to_order += 1
+
+        # x is an ancestor of all famous witnesses of round r if each of them knows an event by x's creator
+        # which is at least as high as x
+        famous_witnesses = [hg.lookup_table[w] for w in hg.witnesses[r].values()
+                            if hg.lookup_table[w].is_famous == Fame.TRUE]
+        seen_heights = None
+        if famous_witnesses:
+            seen_heights = [min([get_height(w.last_ancestors, i) for w in famous_witnesses])
+                            for i in range(len(famous_witnesses[0].last_ancestors))]
+
+        decided_events = []
+        for x_id in hg.unordered_events:
+            x = hg.lookup_table[x_id]
+            if x.round >= r:
                 continue
 
-            # x is an ancestor of all famous witnesses of round r
-            witnesses = [hg.lookup_table[w] for w in hg.witnesses[r].values()]
-            all_famous_witnesses_can_see_x = all([event_can_see_event(hg, w, x) or w.is_famous != Fame.TRUE for w in witnesses])
+            if seen_heights is None or (x.verify_key not in hg.fork_blacklist and
+                                        x.height <= get_height(seen_heights, hg.member_indices[x.verify_key])):
+                decided_events.append(x)
 
-            # ("this is not true of any round earlier than r" because we count up the rounds
-            # If there was an earlier round, we would not reach this point
+        # Consensus times are calculated for the whole round at once
+        consensus_times = get_consensus_times(hg, decided_events, r)
+        confirmation_time = datetime.now().isoformat()
+        for x in decided_events:
+            x.round_received = r
+            x.consensus_timestamp = consensus_times[x.id]
+            x.consensus_time = isoformat_from_timestamp(x.consensus_timestamp)
+            x.confirmation_time = confirmation_time
+            # print("Decided for {}: round_received = {}, time = {}".format(x.short_id, x.round_received, x.consensus_time))
 
-            if all_famous_witnesses_can_see_x:
-                x.round_received = r
-                x.consensus_time = get_consensus_time(hg, x).isoformat()
-                x.confirmation_time = datetime.now().isoformat()
-                # print("Decided for {}: round_received = {}, time = {}".format(x.short_id, x.round_received, x.consensus_time))
-                decided_events.add(x)
+        sorted_events = sorted(decided_events, key=lambda e: (e.round_received, e.consensus_timestamp, e.id))
+        for e in sorted_events:
+            hg.unordered_events.remove(e.id)
+            hg.ordered_events.append(e.id)
 
-    sorted_events = sorted(decided_events, key=lambda e: (e.round_received, e.consensus_time, e.id))
-    for e in sorted_events:
-        e.can_see_cache.clear()
-        hg.unordered_events.remove(e.id)
-        hg.ordered_events.append(e.id)
 
-
-def get_consensus_time(hg, x) -> datetime:
-    times = [dateutil.parser.parse(e.time) for e in get_events_for_consensus_time(hg, x)]
-    timestamps = [int(time.mktime(t.timetuple())) for t in times]
-    median_timestamp = int(median(timestamps)) if timestamps else 0
-    return datetime.fromtimestamp(median_timestamp)
-
-
-def get_events_for_consensus_time(hg, x) -> Set[Event]:
+def get_consensus_times(hg, events: List[Event], r: int) -> Dict[str, int]:
     """
-    "set of each event z such that z is a self-ancestor of a round r unique famous witness,
-    and x is an ancestor of z but not of the self-parent of z"
+    Calculates the consensus time of all events which are received in the same round at once
     :param hg: The hashgraph
-    :param x: The event for which we want to calculate the median timestamp
-    :return:
+    :param events: The events received in round r
+    :param r: The round in which the events are received
+    :return: Dictionary mapping hashes to the consensus time (in microseconds since the epoch)
     """
-    result = set()
+    if len(events) == 0:
+        return {}
+
+    # {event-hash => {event-hash => event}}: For every event, the events whose time is used for the median
+    events_for_consensus_time = {x.id: {} for x in events}
 
     # For all famous round r witnesses
-    r = x.round_received
     for witness_id in hg.witnesses[r].values():
         witness = hg.lookup_table[witness_id]
         if witness.is_famous != Fame.TRUE:
             continue
 
-        # Go through the self ancestors
-        z = hg.lookup_table[witness.parents.self_parent]
-        if z.parents.self_parent is not None:
-            z_self_parent = hg.lookup_table[z.parents.self_parent]
+        for x_id, z in get_events_for_consensus_time(hg, witness, events).items():
+            events_for_consensus_time[x_id][z.id] = z
 
-            while not event_can_see_event(hg, z, x) or event_can_see_event(hg, z_self_parent, x):
-                z = hg.lookup_table[z.parents.self_parent]
-                if z.parents.self_parent is None:  # Special case for the first event - this is not described in the paper
-                    break
-                else:
-                    z_self_parent = hg.lookup_table[z.parents.self_parent]
+    result = {}
+    for x in events:
+        timestamps = [z.timestamp for z in events_for_consensus_time[x.id].values()]
+        result[x.id] = int(median(timestamps)) if timestamps else 0
+
+    return result
+
+
+def get_events_for_consensus_time(hg, witness: Event, events: List[Event]) -> Dict[str, Event]:
+    """
+    "set of each event z such that z is a self-ancestor of a round r unique famous witness,
+    and x is an ancestor of z but not of the self-parent of z"
+    The self-ancestors of the witness are searched by height (binary search) for each event
+    :param hg: The hashgraph
+    :param witness: The famous witness
+    :param events: The events for which we want to calculate the median timestamp
+    :return: Dictionary mapping the hash of each event to its event z
+    """
+    # A witness without self-ancestors can't contribute
+    if witness.height == 0:
+        return {}
+
+    if witness.verify_key in hg.fork_blacklist:
+        # The chain of a member who forked is ambiguous - walk the self-parents
+        self_ancestor_ids = []
+        z = witness
+        while z.parents.self_parent is not None:
+            self_ancestor_ids.append(z.parents.self_parent)
+            z = hg.lookup_table[z.parents.self_parent]
+        self_ancestor_ids.reverse()
+        first_event_id = self_ancestor_ids[0]
+    else:
+        # The beginning of the chain may have been pruned (see Hashgraph.prune()) - its hashes are None
+        self_ancestor_ids = hg.member_chains[witness.verify_key]
+        first_event_id = hg.first_events[witness.verify_key]
+
+    def sees(height, x):
+        # Whether the self-ancestor with the given height sees x - an event doesn't see itself
+        if x.verify_key == witness.verify_key:
+            return height - 1 >= x.height
+        # Evicted (and pruned) events were ordered long ago, so they can't see events that are ordered now
+        if not hg.lookup_table.is_resident(self_ancestor_ids[height]):
+            return False
+        z = hg.lookup_table[self_ancestor_ids[height]]
+        return get_height(z.last_ancestors, hg.member_indices[x.verify_key]) >= x.height
+
+    result = {}
+    top = witness.height - 1
+    for x in events:
+        # Special case for events which the first self ancestor doesn't see (and events of members who forked,
+        # which can't be seen): use the first event - this is not described in the paper
+        if x.verify_key in hg.fork_blacklist or not sees(top, x):
+            result[x.id] = hg.lookup_table[first_event_id]
+            continue
 
-            result.add(z)
-        else:  # Special case for the first event - this is not described in the paper
-            result.add(z)
+        # z is the lowest self ancestor which sees x - every higher one sees it as well
+        low, high = 0, top
+        while low < high:
+            middle = (low + high) // 2
+            if sees(middle, x):
+                high = middle
+            else:
+                low = middle + 1
+        result[x.id] = hg.lookup_table[self_ancestor_ids[low]]
 
     return result
@@ -1,14 +1,44 @@
+import hashlib
+import json
+import queue
 import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Optional, Tuple
+from libnacl import crypto_sign
+from libnacl.encode import base64_decode, base64_encode
 import bptc
-from bptc.data.event import Event, Fame
-from bptc.data.hashgraph import Hashgraph
+from bptc.data.event import Event, Fame, MAX_TIME_LENGTH
+from bptc.data.hashgraph import Hashgraph, filter_valid_events
 from bptc.data.member import Member
+from bptc.data.consensus import index_ancestry
+from bptc.utils.pruned_list import PrunedList
+from bptc.utils.signatures import verify_signature
+from bptc.utils.toposort import toposort
+
+EVENT_COLUMNS = '(hash TEXT PRIMARY KEY, data TEXT, self_parent TEXT, other_parent TEXT, created_time DATETIME,' \
+                'verify_key TEXT, height INT, signature TEXT, round INT, witness BOOL, is_famous BOOL, round_received INT,' \
+                'consensus_time DATETIME, confirmation_time DATETIME, created_timestamp INTEGER,' \
+                'consensus_timestamp INTEGER)'
+MEMBER_STATEMENT = 'INSERT OR REPLACE INTO members VALUES(?, ?, ?, ?, ?, ?, ?)'
+EVENT_STATEMENT = 'INSERT OR REPLACE INTO events VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+# There is only one checkpoint (with ID 0), see Hashgraph.get_checkpoint()
+CHECKPOINT_STATEMENT = 'INSERT OR REPLACE INTO checkpoint VALUES(0, ?, ?, ?)'
 
 
 class DB:
+    """
+    Stores the hashgraph in SQLite. All statements are executed in one thread (see DBThread), so that the
+    connection is never shared - the other methods only prepare the rows and wait for the result.
+    """
 
     __connection = None
     __database_file = None
+    # The thread executing all statements - started on first use
+    __thread = None
+    __thread_lock = threading.Lock()
+    # Makes sure that changes are written in the order in which they are taken from the hashgraph
+    __flush_lock = threading.Lock()
 
     @classmethod
     def __connect(cls) -> None:
@@ -18,16 +48,36 @@ class DB:
         """
         if cls.__connection is None:
             # Connect to DB
-            cls.__connection = sqlite3.connect(cls.__database_file, check_same_thread=False)
+            cls.__connection = sqlite3.connect(cls.__database_file)
 
-            # Create tables if necessary
+            # Storage profile: with the write-ahead log, a commit only appends to the log, and the synchronous
+            # level decides how often SQLite waits for the disk
             c = cls.__connection.cursor()
+            c.execute('PRAGMA journal_mode={}'.format(bptc.db_journal_mode))
+            c.execute('PRAGMA synchronous={}'.format(bptc.db_synchronous))
+
+            # Create tables if necessary
             c.execute('CREATE TABLE IF NOT EXISTS members (verify_key TEXT PRIMARY KEY, signing_key TEXT, head TEXT,'
                       'stake INT, host TEXT, port INT, name TEXT)')
-            c.execute('CREATE TABLE IF NOT EXISTS events (hash TEXT PRIMARY KEY, data TEXT, self_parent TEXT,'
-                      'other_parent TEXT, created_time DATETIME, verify_key TEXT, height INT, signature TEXT,'
-                      'round INT, witness BOOL, is_famous BOOL, round_received INT, consensus_time DATETIME,'
-                      'confirmation_time DATETIME)')
+            c.execute('CREATE TABLE IF NOT EXISTS events ' + EVENT_COLUMNS)
+            # Events which were pruned from memory (see Hashgraph.prune()) - they aren't loaded on start
+            c.execute('CREATE TABLE IF NOT EXISTS archive ' + EVENT_COLUMNS)
+            c.execute('CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY, round INT, data TEXT,'
+                      'signature TEXT)')
+
+            # Add the columns of newer versions to existing databases
+            columns = [row[1] for row in c.execute('PRAGMA table_info(events)')]
+            if 'created_timestamp' not in columns:
+                c.execute('ALTER TABLE events ADD COLUMN created_timestamp INTEGER')
+            if 'consensus_timestamp' not in columns:
+                c.execute('ALTER TABLE events ADD COLUMN consensus_timestamp INTEGER')
+            c.execute('CREATE INDEX IF NOT EXISTS events_created_timestamp ON events (created_timestamp)')
+            c.execute('CREATE INDEX IF NOT EXISTS events_consensus_order ON events (round_received, consensus_timestamp)')
+            c.execute('CREATE INDEX IF NOT EXISTS events_member_height ON events (verify_key, height)')
+            c.execute('CREATE INDEX IF NOT EXISTS events_round ON events (round)')
+            c.execute('CREATE INDEX IF NOT EXISTS events_consensus_timestamp ON events (consensus_timestamp)')
+            c.execute('CREATE INDEX IF NOT EXISTS archive_member_height ON archive (verify_key, height)')
+            cls.__connection.commit()
 
         else:
             bptc.logger.error("Database has already been connected")
@@ -40,30 +90,100 @@ class DB:
         return cls.__connection.cursor()
 
     @classmethod
-    def __save_member(cls, m: Member) -> None:
+    def __execute(cls, function, *args):
         """
-        Saves a Member object to the database
-        :param m: The Member object to be saved
-        :return: None
+        Runs a function accessing the database in the DB thread
+        :param function: The function
+        :param args: The arguments of the function
+        :return: The result of the function - exceptions are raised again in the calling thread
         """
-        statement = 'INSERT OR REPLACE INTO members VALUES(?, ?, ?, ?, ?, ?, ?)'
-        values = m.to_db_tuple()
-
-        cls.__get_cursor().execute(statement, values)
-        # cls.__connection.commit()
+        with cls.__thread_lock:
+            if cls.__thread is None:
+                cls.__thread = DBThread()
+                cls.__thread.daemon = True
+                cls.__thread.start()
+        return cls.__thread.execute(function, *args)
 
     @classmethod
-    def __save_event(cls, e: Event) -> None:
+    def __write(cls, member_tuples: Iterable[Tuple], event_tuples: Iterable[Tuple],
+                checkpoint_tuple: Optional[Tuple] = None) -> None:
         """
-        Saves an Event object to the database
-        :param e: The Event object to be saved
+        Stores members, events and a checkpoint in one transaction (DB thread only)
+        :param member_tuples: The members, as returned by Member.to_db_tuple()
+        :param event_tuples: The events, as returned by Event.to_db_tuple()
+        :param checkpoint_tuple: The checkpoint, see DB.__signed_checkpoint() [Optional]
         :return: None
         """
-        statement = 'INSERT OR REPLACE INTO events VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-        values = e.to_db_tuple()
+        c = cls.__get_cursor()
+        try:
+            c.executemany(MEMBER_STATEMENT, member_tuples)
+            c.executemany(EVENT_STATEMENT, event_tuples)
+            if checkpoint_tuple is not None:
+                c.execute(CHECKPOINT_STATEMENT, checkpoint_tuple)
+            cls.__connection.commit()
+        except sqlite3.Error:
+            cls.__connection.rollback()
+            raise
+
+    @classmethod
+    def __write_copy(cls, database_file: str, member_tuples: List[Tuple], event_tuples: List[Tuple]) -> None:
+        """
+        Stores members and events in another database file, along with the events that are only stored in the
+        database (DB thread only)
+        """
+        orig_connection = cls.__connection
+        orig_file = cls.__database_file
+        cls.__connection = None
+        cls.__database_file = database_file
+        try:
+            cls.__write(member_tuples, event_tuples)
+            c = cls.__get_cursor()
+            c.execute('ATTACH DATABASE ? AS original', (orig_file,))
+            c.execute('INSERT OR IGNORE INTO events SELECT * FROM original.events')
+            c.execute('INSERT OR IGNORE INTO archive SELECT * FROM original.archive')
+            cls.__connection.commit()
+            c.execute('DETACH DATABASE original')
+            cls.__connection.close()
+        finally:
+            cls.__connection = orig_connection
+            cls.__database_file = orig_file
+
+    @classmethod
+    def __archive(cls, event_ids: List[str]) -> None:
+        """Moves events to the archive in one transaction (DB thread only)."""
+        c = cls.__get_cursor()
+        try:
+            # Stay below SQLite's limit of variables per statement
+            for start in range(0, len(event_ids), 500):
+                batch = event_ids[start:start + 500]
+                condition = 'hash IN ({})'.format(', '.join('?' * len(batch)))
+                c.execute('INSERT OR REPLACE INTO archive SELECT * FROM events WHERE ' + condition, batch)
+                c.execute('DELETE FROM events WHERE ' + condition, batch)
+            cls.__connection.commit()
+        except sqlite3.Error:
+            cls.__connection.rollback()
+            raise
 
-        cls.__get_cursor().execute(statement, values)
-        # cls.__connection.commit()
+    @classmethod
+    def __prune(cls, hashgraph: Hashgraph) -> List[str]:
+        """
+        Evicts the events ordered long ago from memory, archives them and prunes them from the hashgraph, see
+        Hashgraph.prune(). The evicted events must have been stored - if they can't be archived, they are kept for
+        the next call
+        :param hashgraph: The hashgraph
+        :return: The hashes of the archived events
+        """
+        evicted_events = hashgraph.unarchived_events + hashgraph.evict_events()
+        hashgraph.unarchived_events = []
+        if evicted_events:
+            try:
+                cls.__execute(cls.__archive, evicted_events)
+            except sqlite3.Error:
+                # Try again with the next flush
+                hashgraph.unarchived_events = evicted_events
+                raise
+        hashgraph.prune(evicted_events)
+        return evicted_events
 
     @classmethod
     def save(cls, obj, temp=False) -> None:
@@ -74,41 +194,181 @@ class DB:
         :return: None
         """
         if isinstance(obj, Member):
-            cls.__save_member(obj)
+            cls.__execute(cls.__write, [obj.to_db_tuple()], [])
         elif isinstance(obj, Event):
-            cls.__save_event(obj)
+            cls.__execute(cls.__write, [], [obj.to_db_tuple()])
+        elif isinstance(obj, Hashgraph) and not temp:
+            # Only store events whose consensus was calculated
+            obj.advance_consensus()
+            # Everything else was already stored in the background
+            cls.flush(obj)
         elif isinstance(obj, Hashgraph):
-            if temp:
-                orig_connection = cls.__connection
-                orig_file = cls.__database_file
-                cls.__connection = None
-                # Round to the next hundreds
-                number_events = round(len(obj.lookup_table) / 100) * 100
-                cls.__database_file = cls.__database_file.replace('data.db', 'data{}.db'.format(number_events))
+            # Round to the next hundreds
+            number_events = round(len(obj.lookup_table) / 100) * 100
+            database_file = cls.__database_file.replace('data.db', 'data{}.db'.format(number_events))
             with obj.lock:
-                cls.__save_member(obj.me)
-                for member in obj.known_members.values():
-                    cls.__save_member(member)
-
-                for event in obj.lookup_table.values():
-                    cls.__save_event(event)
-            if temp:
-                cls.__connection.commit()
-                cls.__connection = orig_connection
-                cls.__database_file = orig_file
+                # Only store events whose consensus was calculated
+                obj.advance_consensus()
+
+                with obj.consensus_lock:
+                    member_tuples = [member.to_db_tuple() for member in obj.known_members.values()]
+                    event_tuples = [event.to_db_tuple() for event in obj.lookup_table.resident.values()]
+            cls.__execute(cls.__write_copy, database_file, member_tuples, event_tuples)
         else:
             bptc.logger.error("Could not persist object because its type is not supported")
-        cls.__connection.commit()
 
     @classmethod
-    def load_hashgraph(cls, db_file) -> Hashgraph:
+    def flush(cls, hashgraph: Hashgraph) -> None:
+        """
+        Stores all members and the events which were added or changed since the last flush (see
+        Hashgraph.dirty_events) in one transaction - along with a new checkpoint if another round was decided
+        :param hashgraph: The hashgraph
+        :return: None
+        """
+        with cls.__flush_lock:
+            if hashgraph.discarded:
+                return
+
+            # Not taking the lock of the hashgraph - the debug mode stores the hashgraph while holding it
+            member_tuples = [member.to_db_tuple() for member in list(hashgraph.known_members.values())]
+            checkpoint_round = hashgraph.checkpoint_round
+            checkpoint_data = None
+            with hashgraph.consensus_lock:
+                hashgraph.flush_needed.clear()
+                dirty_events, hashgraph.dirty_events = hashgraph.dirty_events, set()
+                event_tuples = [hashgraph.lookup_table[event_id].to_db_tuple() for event_id in dirty_events]
+                if hashgraph.next_round_to_order - 1 > checkpoint_round and hashgraph.me.signing_key is not None:
+                    checkpoint = hashgraph.get_checkpoint()
+                    checkpoint_data = json.dumps(checkpoint)
+                    hashgraph.checkpoint_round = checkpoint['round']
+
+            checkpoint_tuple = None
+            if checkpoint_data is not None:
+                checkpoint_tuple = cls.__signed_checkpoint(hashgraph.checkpoint_round, checkpoint_data,
+                                                           hashgraph.me.signing_key)
+
+            try:
+                cls.__execute(cls.__write, member_tuples, event_tuples, checkpoint_tuple)
+            except sqlite3.Error:
+                # Try again with the next flush
+                with hashgraph.consensus_lock:
+                    hashgraph.dirty_events |= dirty_events
+                    hashgraph.checkpoint_round = checkpoint_round
+                raise
+
+            # Events ordered long ago are only needed in the database from now on
+            cls.__prune(hashgraph)
+
+    @staticmethod
+    def __signed_checkpoint(checkpoint_round: int, checkpoint_data: str, signing_key: str) -> Tuple:
+        """Signs a checkpoint, so that it can't be changed without noticing, and returns it as a row."""
+        signature = crypto_sign(checkpoint_data.encode('UTF-8'), base64_decode(signing_key.encode('UTF-8')))
+        return checkpoint_round, checkpoint_data, base64_encode(signature).decode('UTF-8')
+
+    @staticmethod
+    def __verified_checkpoint(checkpoint_row: Optional[Tuple], me: Member) -> Optional[Dict]:
+        """
+        Checks the signature of a stored checkpoint
+        :param checkpoint_row: The stored checkpoint (None if there is none)
+        :param me: The member who signed it
+        :return: The checkpoint (see Hashgraph.get_checkpoint()) or None if there is no valid checkpoint
+        """
+        if checkpoint_row is None or me is None:
+            return None
+        _, checkpoint_data, signature = checkpoint_row[1:]
+        if not verify_signature(signature, me.verify_key, checkpoint_data.encode('UTF-8')):
+            bptc.logger.warn('The checkpoint has an invalid signature - loading without it')
+            return None
+        return json.loads(checkpoint_data)
+
+    @classmethod
+    def __read(cls, db_file: str) -> Tuple[List[Tuple], List[Tuple], Optional[Tuple], int]:
+        """Reads all members, the events which weren't archived, the checkpoint and the number of archived events
+        (DB thread only)."""
         cls.__database_file = db_file
         c = cls.__get_cursor()
+        return (c.execute('SELECT * FROM members').fetchall(), c.execute('SELECT * FROM events').fetchall(),
+                c.execute('SELECT * FROM checkpoint').fetchone(),
+                c.execute('SELECT COUNT(*) FROM archive').fetchone()[0])
+
+    @classmethod
+    def __read_archive(cls) -> Tuple[List[Tuple], List[Tuple]]:
+        """Reads all archived events and the hashes of the archived first events of members (DB thread only)."""
+        c = cls.__get_cursor()
+        return (c.execute('SELECT * FROM archive').fetchall(),
+                c.execute('SELECT verify_key, hash FROM archive WHERE height = 0').fetchall())
+
+    @classmethod
+    def __read_events(cls, event_ids: List[str]) -> List[Tuple]:
+        """Reads the events with the given hashes, archived or not (DB thread only)."""
+        c = cls.__get_cursor()
+        rows = []
+        # Stay below SQLite's limit of variables per statement
+        for start in range(0, len(event_ids), 500):
+            batch = event_ids[start:start + 500]
+            condition = 'hash IN ({})'.format(', '.join('?' * len(batch)))
+            rows += c.execute('SELECT * FROM events WHERE {0} UNION ALL SELECT * FROM archive WHERE {0}'.format(
+                condition), batch + batch).fetchall()
+        return rows
+
+    @classmethod
+    def __read_chain(cls, member_id: str, start_height: int, end_height: int) -> List[Tuple]:
+        """Reads the events of a member between two heights, archived or not (DB thread only)."""
+        c = cls.__get_cursor()
+        return c.execute('SELECT * FROM events WHERE verify_key = ? AND height >= ? AND height < ? UNION ALL '
+                         'SELECT * FROM archive WHERE verify_key = ? AND height >= ? AND height < ? ORDER BY height',
+                         (member_id, start_height, end_height) * 2).fetchall()
+
+    @classmethod
+    def __read_archived_events(cls, position: int, count: int) -> List[Tuple]:
+        """Reads archived events in the order in which they were archived (DB thread only)."""
+        c = cls.__get_cursor()
+        return c.execute('SELECT rowid, * FROM archive WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                         (position, count)).fetchall()
+
+    @classmethod
+    def read_events(cls, event_ids: List[str]) -> Dict[str, Event]:
+        """
+        Reads stored events, e.g. events which were evicted from memory (see EventStore)
+        :param event_ids: The hashes of the events
+        :return: Dictionary mapping the hashes of the stored events to the events
+        """
+        return {row[0]: Event.from_db_tuple(row) for row in cls.__execute(cls.__read_events, event_ids)}
+
+    @classmethod
+    def read_chain(cls, member_id: str, start_height: int, end_height: int) -> List[Event]:
+        """
+        Reads the stored events of a member between two heights, e.g. the pruned beginning of its chain (see
+        EventStore)
+        :param member_id: The ID of the member
+        :param start_height: The height of the first event
+        :param end_height: The height after the last event
+        :return: The events, ordered by height
+        """
+        return [Event.from_db_tuple(row) for row in cls.__execute(cls.__read_chain, member_id, start_height,
+                                                                  end_height)]
+
+    @classmethod
+    def read_archived_events(cls, position: int, count: int) -> Tuple[int, List[Event]]:
+        """
+        Reads archived events in the order in which they were archived (see EventStore)
+        :param position: The position after which to read - 0 for the first event, then the returned position
+        :param count: The maximum number of events
+        :return: The position of the last event and the events
+        """
+        rows = cls.__execute(cls.__read_archived_events, position, count)
+        if not rows:
+            return position, []
+        return rows[-1][0], [Event.from_db_tuple(row[1:]) for row in rows]
+
+    @classmethod
+    def load_hashgraph(cls, db_file) -> Hashgraph:
+        member_rows, event_rows, checkpoint_row, archived_count = cls.__execute(cls.__read, db_file)
 
         # Load members
         me = None
         members = dict()
-        for row in c.execute('SELECT * FROM members'):
+        for row in member_rows:
             member = Member.from_db_tuple(row)
             members[member.id] = member
             if member.signing_key is not None:
@@ -116,75 +376,243 @@ class DB:
 
         # Load events
         events = dict()
-        for row in c.execute('SELECT * FROM events'):
+        for row in event_rows:
             events[row[0]] = Event.from_db_tuple(row)
 
         # Create hashgraph
         hg = Hashgraph(me)
         hg.known_members = members
 
-        # check parent links and signatures
-        for event_id, event in events.items():
-            if event.parents.self_parent is not None:
-                if event.parents.self_parent not in events:
-                    raise AssertionError
-            if event.parents.other_parent is not None:
-                if event.parents.other_parent not in events:
-                    raise AssertionError
-            if not event.has_valid_signature:
-                bptc.logger.warn("Event had invalid signature: {}".format(event))
-                raise AssertionError
-
-        hg.lookup_table = events
+        # The events ordered before the checkpoint was stored were already checked - if they match the checkpoint
+        # The archived events are only restored from the checkpoint, see Hashgraph.prune()
+        checkpoint = cls.__verified_checkpoint(checkpoint_row, me)
+        checkpoint_events = []
+        if checkpoint is not None:
+            checkpoint_events = sorted([e for e in events.values()
+                                        if e.round_received is not None and e.round_received <= checkpoint['round']],
+                                       key=lambda e: (e.round_received, e.consensus_timestamp, e.id))
+            checkpoint_events_hash = ''
+            for event in checkpoint_events:
+                checkpoint_events_hash = hashlib.sha512((checkpoint_events_hash + event.id).encode('UTF-8')).hexdigest()
+            # The hash can't be checked without the archived events - only their number
+            if archived_count + len(checkpoint_events) != checkpoint['ordered_events'] or \
+                    (archived_count == 0 and checkpoint_events_hash != checkpoint['ordered_events_hash']):
+                bptc.logger.warn('The checkpoint does not match the stored events - loading without it')
+                checkpoint = None
+                checkpoint_events = []
+
+        archived_first_events = []
+        if archived_count > 0:
+            if checkpoint is None:
+                # All events need to be replayed
+                archived_rows, archived_first_events = cls.__execute(cls.__read_archive)
+                for row in archived_rows:
+                    events[row[0]] = Event.from_db_tuple(row)
+                archived_count = 0
+            else:
+                archived_first_events = cls.__execute(cls.__read_archive)[1]
+
+        # check parent links - the parents of the first events after the archived ones are archived
+        missing_parents = set(parent_id for event in events.values() for parent_id in event.parents
+                              if parent_id is not None and parent_id not in events)
+        if missing_parents and (archived_count == 0 or len(cls.read_events(list(missing_parents))) !=
+                                len(missing_parents)):
+            raise AssertionError
+
+        # the binary format of pushes can't encode longer times, see Event.from_dict()
+        if any(len(event.time.encode('UTF-8')) > MAX_TIME_LENGTH for event in events.values()):
+            raise AssertionError
+
+        # check signatures of the other events (only the events of the last rounds are left besides the archived ones)
+        checkpoint_event_ids = set(e.id for e in checkpoint_events) if archived_count == 0 else set()
+        unchecked_events = {event_id: event for event_id, event in events.items()
+                            if event_id not in checkpoint_event_ids}
+        if len(filter_valid_events(unchecked_events)) != len(unchecked_events):
+            raise AssertionError
+
+        hg.lookup_table.resident = events
+        hg.lookup_table.evicted_count = archived_count
+        hg.pruned_events_count = archived_count
+
+        # The chains start after their archived events
+        for event in events.values():
+            if event.verify_key not in hg.member_chains or event.height < hg.member_chains[event.verify_key].offset:
+                hg.member_chains[event.verify_key] = PrunedList(offset=event.height)
+
+        # Create ancestry and height index
+        for event in toposort(events):
+            hg.events.append(event.id)
+            index_ancestry(hg, event)
+            if hg.index_height(event):
+                hg.fork_blacklist.add(event.verify_key)
+        for member_id, event_id in archived_first_events:
+            hg.first_events.setdefault(member_id, event_id)
 
         # Create witness lookup
-        for event_id, event in hg.lookup_table.items():
+        for event_id, event in events.items():
             if event.is_witness:
                 hg.witnesses[event.round][event.verify_key] = event.id
 
-        # Create fame lookup
+        # Create fame lookup - the fame of pruned rounds was decided
+        if checkpoint is not None:
+            hg.pruned_round = checkpoint['pruned_round']
         if len(hg.witnesses) > 0:
-            for x_round in range(0, max(hg.witnesses) + 1):
+            for x_round in range(hg.pruned_round + 1, max(hg.witnesses) + 1):
+                witnesses = hg.witnesses.get(x_round, {})
                 decided_witnesses_in_round_x_count = 0
-                for x_id in hg.witnesses[x_round].values():
-                    if hg.lookup_table[x_id] != Fame.UNDECIDED:
+                for x_id in witnesses.values():
+                    if hg.lookup_table[x_id].is_famous != Fame.UNDECIDED:
                         decided_witnesses_in_round_x_count += 1
 
-                if decided_witnesses_in_round_x_count == len(hg.witnesses[x_round].items()):
+                if decided_witnesses_in_round_x_count == len(witnesses):
                     hg.rounds_with_decided_fame.add(x_round)
+                else:
+                    hg.undecided_witnesses |= set(x_id for x_id in witnesses.values()
+                                                  if hg.lookup_table[x_id].is_famous == Fame.UNDECIDED)
+
+        # Continue ordering with the first round whose order wasn't found yet
+        hg.next_round_to_order = hg.pruned_round + 1
+        while hg.next_round_to_order in hg.rounds_with_decided_fame:
+            hg.next_round_to_order += 1
 
         # Create cache of undecided and decided events
         ordered_events = []
-        for event_id, event in hg.lookup_table.items():
+        for event_id, event in events.items():
             if event.round_received is None:
                 hg.unordered_events.add(event_id)
             else:
                 ordered_events.append(event)
 
-        ordered_events = sorted(ordered_events, key=lambda e: (e.round_received, e.consensus_time, e.id))
-        hg.ordered_events = [e.id for e in ordered_events]
+        # The archived events were ordered (and processed) before
+        ordered_events = sorted(ordered_events, key=lambda e: (e.round_received, e.consensus_timestamp, e.id))
+        hg.ordered_events = PrunedList([e.id for e in ordered_events], offset=archived_count)
+        hg.next_ordered_event_idx_to_evict = archived_count
 
-        bptc.logger.debug('Loaded {} events from DB.'.format(len(events)))
+        bptc.logger.debug('Loaded {} events from DB ({} archived).'.format(len(events), archived_count))
+
+        if checkpoint is not None:
+            # Restore the state of the checkpoint instead of replaying the transactions before it
+            bptc.logger.debug('Restored checkpoint of round {} ({} events)'.format(checkpoint['round'],
+                                                                                  checkpoint['ordered_events']))
+            hg.checkpoint_round = checkpoint['round']
+            hg.next_ordered_event_idx_to_process = checkpoint['ordered_events']
+            hg.ordered_events_hash = checkpoint['ordered_events_hash']
+            hg.denied_transactions = set(tuple(t) for t in checkpoint['denied_transactions'])
+            hg.fork_blacklist.update(checkpoint['fork_blacklist'])
+            for member_id, state in checkpoint['members'].items():
+                if member_id in hg.known_members:
+                    hg.known_members[member_id].account_balance = state['balance']
+                    hg.known_members[member_id].name = state['name']
+            for event in checkpoint_events:
+                hg.restore_event(event)
 
         # Create cached account balances
         hg.process_ordered_events()
 
+        # Only keep the events in memory which may still be needed for the consensus
+        bptc.logger.debug('Archived {} events ordered long ago'.format(len(cls.__prune(hg))))
+
         return hg
 
     @classmethod
-    def reset(cls):
+    def __disconnect(cls) -> None:
+        """Closes the connection (DB thread only)."""
+        if cls.__connection is not None:
+            cls.__connection.close()
+            cls.__connection = None
+
+    @classmethod
+    def close(cls) -> None:
         """
-        Removes all entries from the DB
+        Closes the connection to the database - the next call connects again, e.g. to another database file
         :return: None
         """
+        cls.__execute(cls.__disconnect)
+
+    @classmethod
+    def __delete_all(cls) -> None:
+        """Removes all members and events (DB thread only)."""
+        c = cls.__get_cursor()
 
         # Remove all events
         statement = 'DELETE from events'
-        cls.__get_cursor().execute(statement)
+        c.execute(statement)
+        statement = 'DELETE from archive'
+        c.execute(statement)
 
         # Remove all members
         statement = 'DELETE from members'
-        cls.__get_cursor().execute(statement)
+        c.execute(statement)
+
+        # Remove the checkpoint
+        statement = 'DELETE from checkpoint'
+        c.execute(statement)
 
         # Commit
         cls.__connection.commit()
+
+    @classmethod
+    def reset(cls, discarded: Optional[Hashgraph] = None):
+        """
+        Removes all entries from the DB
+        :param discarded: A hashgraph which was replaced - it isn't stored afterwards, even if it is still being
+                          flushed in the background [Optional]
+        :return: None
+        """
+        with cls.__flush_lock:
+            if discarded is not None:
+                discarded.discarded = True
+            cls.__execute(cls.__delete_all)
+
+
+class DBThread(threading.Thread):
+    """Thread executing all statements of the database, see DB."""
+
+    def __init__(self):
+        super(DBThread, self).__init__()
+        self.q = queue.Queue()
+
+    def execute(self, function, *args):
+        """
+        Runs a function in this thread and waits for its result
+        :param function: The function
+        :param args: The arguments of the function
+        :return: The result of the function
+        """
+        if threading.current_thread() is self:
+            return function(*args)
+        future = Future()
+        self.q.put((function, args, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            function, args, future = self.q.get()
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class DBWriterThread(threading.Thread):
+    """Thread responsible for storing the changes of the hashgraph in the background, see DB.flush()."""
+
+    def __init__(self, network):
+        super(DBWriterThread, self).__init__()
+        self.network = network
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self.stopped():
+            # The hashgraph is replaced when it is reset
+            self.network.hashgraph.flush_needed.wait(bptc.db_flush_interval)
+            try:
+                DB.flush(self.network.hashgraph)
+            except sqlite3.Error as e:
+                bptc.logger.error('Could not store the hashgraph: {}'.format(e))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
@@ -1,11 +1,43 @@
 import datetime
 import collections
+from array import array
 from collections import OrderedDict
 from bptc.data.transaction import Transaction
 from typing import Dict, List, Tuple
 import json
-from libnacl import crypto_hash_sha512, crypto_sign_open, crypto_sign
+import dateutil.parser
+from libnacl import crypto_hash_sha512, crypto_sign
 from libnacl.encode import base64_encode, base64_decode
+from bptc.utils.signatures import verify_signature
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The binary format of pushes stores the length of the time of an event in one byte (see binary_format.py)
+MAX_TIME_LENGTH = 255
+
+if hasattr(datetime.datetime, 'fromisoformat'):
+    _parse_isoformat = datetime.datetime.fromisoformat
+else:
+    def _parse_isoformat(time: str) -> datetime.datetime:
+        return datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def timestamp_from_isoformat(time: str) -> int:
+    """Converts a time in ISO format (as created by datetime.isoformat()) to microseconds since the epoch."""
+    try:
+        parsed_time = _parse_isoformat(time)
+    except ValueError:
+        parsed_time = dateutil.parser.parse(time)
+    # Both parsers accept offsets - times are compared in UTC
+    if parsed_time.tzinfo is not None:
+        parsed_time = parsed_time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (parsed_time - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def isoformat_from_timestamp(timestamp: int) -> str:
+    """Converts microseconds since the epoch to a time in ISO format."""
+    return (EPOCH + datetime.timedelta(microseconds=timestamp)).isoformat()
 
 
 class Parents(collections.namedtuple("Parents", ["self_parent", "other_parent"])):
@@ -28,7 +60,12 @@ class Event:
     An Event is a node in the hashgraph - it may contain transactions
     """
 
-    def __init__(self, verify_key, data: List[Transaction], parents: Parents, time=None):
+    # There are a lot of events - don't waste memory on a __dict__ for each of them
+    __slots__ = ('data', 'parents', 'time', 'verify_key', 'timestamp', '__body', '__id', 'height', 'round', 'votes',
+                 'signature', 'is_witness', 'is_famous', 'round_received', 'consensus_time', 'consensus_timestamp',
+                 'last_ancestors', 'first_descendants', 'confirmation_time')
+
+    def __init__(self, verify_key, data: List[Transaction], parents: Parents, time=None, event_id=None):
         # Immutable body of Event
         self.data = data
         self.parents = parents
@@ -36,8 +73,13 @@ class Event:
         self.verify_key = verify_key
         # End of immutable body
 
-        # Compute Event hash and ID
-        self.__id = base64_encode(crypto_hash_sha512(self.body.encode("UTF-8"))).decode("UTF-8")
+        # The time in microseconds since the epoch (used for calculations and sorting)
+        self.timestamp = timestamp_from_isoformat(self.time)
+
+        # The serialized body and the ID (hash of the body) are computed on first use
+        # The ID of a received event may be taken over from the sender - see has_valid_id
+        self.__body = None
+        self.__id = event_id
 
         # Event is always created with height 0
         # The real height is determined once the event is added to the hashgraph
@@ -61,9 +103,17 @@ class Event:
         # Ordering info
         self.round_received = None
         self.consensus_time = None
+        self.consensus_timestamp = None
 
-        # A cache for event visibility
-        self.can_see_cache = dict()
+        # [height]: Height of the latest ancestor (including the event itself) created by each member,
+        # indexed by Hashgraph.member_index() - -1 or missing at the end if there is none
+        # Filled once the event is added to the hashgraph
+        self.last_ancestors = array('i')
+
+        # [height]: Height of the earliest descendant (including the event itself) created by each member,
+        # indexed like last_ancestors
+        # Grows while descendants are added to the hashgraph
+        self.first_descendants = array('i')
 
         # time when the client learns about the confirmation
         self.confirmation_time = None
@@ -76,37 +126,68 @@ class Event:
         return self.__str__()
 
     @property
-    def body(self):
+    def body(self) -> str:
         """The part of an event that gets signed."""
+        return self.body_bytes.decode("UTF-8")
 
-        return json.dumps(OrderedDict([
-            ('data', [x.to_dict() for x in self.data] if self.data is not None else None),
-            ('self_parent', self.parents.self_parent),
-            ('other_parent', self.parents.other_parent),
-            ('time', self.time),
-            ('verify_key', self.verify_key)]
-        ))
+    @property
+    def body_bytes(self) -> bytes:
+        """The body encoded as UTF-8 - this is what gets hashed and signed. It is only serialized once."""
+        if self.__body is None:
+            self.__body = json.dumps(OrderedDict([
+                ('data', [x.to_dict() for x in self.data] if self.data is not None else None),
+                ('self_parent', self.parents.self_parent),
+                ('other_parent', self.parents.other_parent),
+                ('time', self.time),
+                ('verify_key', self.verify_key)]
+            )).encode("UTF-8")
+        return self.__body
+
+    def release_body(self) -> None:
+        """Frees the memory of the cached body - it is serialized again if it is needed later on."""
+        self.__body = None
 
     @property
     def id(self):
+        if self.__id is None:
+            self.__id = self.compute_id()
         return self.__id
 
+    def compute_id(self) -> str:
+        """Computes the ID of the event, which is the hash of its body."""
+        return base64_encode(crypto_hash_sha512(self.body_bytes)).decode("UTF-8")
+
+    @property
+    def has_valid_id(self) -> bool:
+        """
+        Checks whether the ID of the event matches its body - IDs taken over from other members are only trusted
+        until this is checked
+        :return: bool
+        """
+        return self.__id is None or self.__id == self.compute_id()
+
     @classmethod
-    def from_debug_dict(cls, dict_event) -> "Event":
-        """This is only used for the visualization!"""
+    def from_debug_dict(cls, dict_event, event_id=None) -> "Event":
+        """
+        This is only used for the visualization!
+        :param dict_event: The dict created with Event.to_debug_dict()
+        :param event_id: The ID of the event if it is known - it is trusted without hashing the event
+        """
 
         data = None
         if dict_event['data'] is not None:
             data = [Transaction.from_dict(x) for x in dict_event['data']]
 
         event = Event(dict_event['verify_key'],
-                      data, Parents(dict_event['parents'][0], dict_event['parents'][1]), dict_event['time'])
+                      data, Parents(dict_event['parents'][0], dict_event['parents'][1]), dict_event['time'], event_id)
         event.height = dict_event['height']
         event.signature = dict_event['signature']
         event.is_witness = dict_event['witness']
         event.is_famous = dict_event['is_famous']
         event.round_received = dict_event['round_received']
         event.consensus_time = dict_event['consensus_time']
+        if event.consensus_time is not None:
+            event.consensus_timestamp = timestamp_from_isoformat(event.consensus_time)
         event.round = dict_event['round']
         return event
 
@@ -128,15 +209,23 @@ class Event:
         ])
 
     @classmethod
-    def from_dict(cls, dict_event) -> "Event":
-        """Instantiate an event from a dict created with Event.to_dict()."""
+    def from_dict(cls, dict_event, event_id=None) -> "Event":
+        """
+        Instantiate an event from a dict created with Event.to_dict().
+        :param dict_event: The dict
+        :param event_id: The ID sent along with the event - it is trusted until has_valid_id is checked
+        :return: The event
+        """
+
+        if len(dict_event['time'].encode('UTF-8')) > MAX_TIME_LENGTH:
+            raise ValueError('The time of an event must not be longer than {} bytes'.format(MAX_TIME_LENGTH))
 
         data = None
         if dict_event['data'] is not None:
             data = [Transaction.from_dict(x) for x in dict_event['data']]
 
         event = Event(dict_event['verify_key'],
-                      data, Parents(dict_event['parents'][0], dict_event['parents'][1]), dict_event['time'])
+                      data, Parents(dict_event['parents'][0], dict_event['parents'][1]), dict_event['time'], event_id)
         event.signature = dict_event['signature']
         return event
 
@@ -168,7 +257,9 @@ class Event:
             self.is_famous,
             self.round_received,
             self.consensus_time,
-            self.confirmation_time
+            self.confirmation_time,
+            self.timestamp,
+            self.consensus_timestamp
         )
 
     @classmethod
@@ -182,7 +273,8 @@ class Event:
         event = Event(e[5],
                       data,
                       Parents(e[2], e[3]),
-                      e[4])
+                      e[4],
+                      e[0])
 
         event.height = e[6]
         event.signature = e[7]
@@ -192,6 +284,11 @@ class Event:
         event.round_received = e[11]
         event.consensus_time = e[12]
         event.confirmation_time = e[13]
+        if len(e) > 15 and e[15] is not None:
+            event.consensus_timestamp = e[15]
+        elif event.consensus_time is not None:
+            # Databases created by older versions only contain the ISO format
+            event.consensus_timestamp = timestamp_from_isoformat(event.consensus_time)
 
         return event
 
@@ -202,7 +299,7 @@ class Event:
         :return: None
         """
         signing_key_byte = base64_decode(signing_key.encode("UTF-8"))
-        self.signature = base64_encode(crypto_sign(self.body.encode("UTF-8"), signing_key_byte)).decode("UTF-8")
+        self.signature = base64_encode(crypto_sign(self.body_bytes, signing_key_byte)).decode("UTF-8")
 
     @property
     def has_valid_signature(self) -> bool:
@@ -210,10 +307,4 @@ class Event:
         Checks whether the event has a valid signature
         :return: bool
         """
-        signature_byte = base64_decode(self.signature.encode("UTF-8"))
-        verify_key_byte = base64_decode(self.verify_key.encode("UTF-8"))
-        try:
-            message = crypto_sign_open(signature_byte, verify_key_byte)
-            return message.decode('UTF-8') == self.body
-        except ValueError:
-            return False
+        return verify_signature(self.signature, self.verify_key, self.body_bytes)
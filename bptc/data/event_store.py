@@ -0,0 +1,174 @@
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List
+import bptc
+from bptc.data.event import Event
+
+"""
+Keeps the events of a hashgraph - the recent ones in memory and the ones which were ordered long ago in the database.
+
+Events are evicted from memory once their order is final for bptc.event_horizon_rounds rounds and they are stored (see
+Hashgraph.evict_events()). Consensus doesn't need them any more, but the transaction history, members who are far
+behind and the visualization still do - they are read from the database again. The evicted events that were read
+last are cached (bptc.event_cache_size events, the least recently used are dropped).
+
+Evicted events are archived in the database and pruned from the lists of the hashgraph (see Hashgraph.prune()), so
+they can also be read by their creator and height, or all at once.
+"""
+
+
+class EventStore:
+    """
+    Maps the hashes of events to the events, like a dict
+    """
+
+    def __init__(self, restore: Callable[[Event], None]):
+        self.lock = threading.Lock()
+        # {event-hash => Event}: The events kept in memory
+        self.resident = {}
+        # {event-hash => Event}: Evicted events which were read again, least recently used first
+        self.cache = OrderedDict()
+        # {event-hash => None}: Hashes which were looked up last without being found (events received by other members
+        # are looked up several times before they are added), least recently used first
+        self.unknown = OrderedDict()
+        # int: The number of evicted events
+        self.evicted_count = 0
+        # Restores the state of an event read from the database which isn't stored, e.g. the status of transactions
+        self.restore = restore
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.resident) + self.evicted_count
+
+    def __contains__(self, event_id: str) -> bool:
+        return self.get(event_id) is not None
+
+    def __getitem__(self, event_id: str) -> Event:
+        event = self.get(event_id)
+        if event is None:
+            raise KeyError(event_id)
+        return event
+
+    def __setitem__(self, event_id: str, event: Event) -> None:
+        self.resident[event_id] = event
+
+    def get(self, event_id: str, default=None):
+        """
+        Returns an event, reading it from the database if it was evicted
+        :param event_id: The hash of the event
+        :param default: Returned if there is no such event [Optional]
+        :return: The event or default
+        """
+        event = self.resident.get(event_id)
+        if event is not None:
+            return event
+        if self.evicted_count == 0:
+            return default
+
+        with self.lock:
+            event = self.cache.get(event_id)
+            if event is not None:
+                self.cache.move_to_end(event_id)
+                self.hits += 1
+                return event
+            if event_id in self.unknown:
+                return default
+            self.misses += 1
+            evicted_count = self.evicted_count
+
+        event = self.__read([event_id]).get(event_id)
+
+        with self.lock:
+            if event is None:
+                # Added events are found in memory - only events evicted meanwhile could be missing
+                if self.evicted_count == evicted_count:
+                    self.unknown[event_id] = None
+                    while len(self.unknown) > bptc.event_cache_size:
+                        self.unknown.popitem(last=False)
+                return default
+            self.cache[event_id] = event
+            while len(self.cache) > bptc.event_cache_size:
+                self.cache.popitem(last=False)
+        return event
+
+    def is_resident(self, event_id: str) -> bool:
+        """Whether an event is kept in memory - evicted events can be read without being changed."""
+        return event_id in self.resident
+
+    def iter_events(self, event_ids: Iterable[str], batch_size: int = 500) -> Iterator[Event]:
+        """
+        Returns the events with the given hashes in the same order. Evicted events are read in batches and aren't
+        cached, so that going through the whole history doesn't drop the cached events
+        :param event_ids: The hashes of the events, all of them must be known
+        :param batch_size: Number of events read at once [Optional]
+        :return: Iterator over the events
+        """
+        event_ids = iter(event_ids)
+        batch = list(islice(event_ids, batch_size))
+        while batch:
+            events = [self.resident.get(event_id) for event_id in batch]
+            missing = [event_id for event_id, event in zip(batch, events) if event is None]
+            if missing:
+                with self.lock:
+                    read_events = {event_id: self.cache[event_id] for event_id in missing if event_id in self.cache}
+                read_events.update(self.__read([event_id for event_id in missing if event_id not in read_events]))
+                events = [read_events[event_id] if event is None else event for event_id, event in zip(batch, events)]
+            yield from events
+            batch = list(islice(event_ids, batch_size))
+
+    def read_chain(self, member_id: str, start_height: int, end_height: int) -> List[Event]:
+        """
+        Reads the stored events of a member between two heights, e.g. the pruned beginning of its chain. They aren't
+        cached
+        :param member_id: The ID of the member
+        :param start_height: The height of the first event
+        :param end_height: The height after the last event
+        :return: The events, ordered by height - forks included
+        """
+        from bptc.data.db import DB
+
+        events = DB.read_chain(member_id, start_height, end_height)
+        for event in events:
+            self.restore(event)
+        return events
+
+    def iter_archived_events(self, batch_size: int = 500) -> Iterator[Event]:
+        """
+        Returns all archived events in the order in which they were archived. They are read in batches and aren't cached
+        :param batch_size: Number of events read at once [Optional]
+        :return: Iterator over the events
+        """
+        from bptc.data.db import DB
+
+        position = 0
+        while True:
+            position, events = DB.read_archived_events(position, batch_size)
+            if not events:
+                return
+            for event in events:
+                self.restore(event)
+            yield from events
+
+    def evict(self, event_id: str) -> None:
+        """
+        Removes an event from memory - it must have been stored in the database
+        :param event_id: The hash of the event
+        :return: None
+        """
+        with self.lock:
+            self.unknown.pop(event_id, None)
+            del self.resident[event_id]
+            self.evicted_count += 1
+
+    def __read(self, event_ids: List[str]) -> Dict[str, Event]:
+        """Reads evicted events from the database."""
+        from bptc.data.db import DB
+
+        if not event_ids:
+            return {}
+        events = DB.read_events(event_ids)
+        for event in events.values():
+            self.restore(event)
+        return events
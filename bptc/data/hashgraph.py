@@ -1,14 +1,18 @@
 import math
 import os
 import threading
-from collections import defaultdict
-from typing import Dict
+from collections import defaultdict, deque
+from typing import Container, Dict, Iterable, Iterator, List, Optional
 import copy
+import hashlib
 from twisted.internet.address import IPv4Address
 import bptc
-from bptc.data.consensus import divide_rounds, decide_fame, find_order
-from bptc.data.event import Event, Parents
+from bptc.data.consensus import divide_rounds, decide_fame, find_order, index_ancestry
+from bptc.data.event import Event, Parents, MAX_TIME_LENGTH
+from bptc.data.event_store import EventStore
 from bptc.data.member import Member
+from bptc.utils.pruned_list import PrunedList
+from bptc.utils.signatures import verify_signatures
 from bptc.utils.toposort import toposort
 from bptc.data.transaction import MoneyTransaction, TransactionStatus, PublishNameTransaction
 
@@ -19,7 +23,10 @@ class Hashgraph:
     """
 
     def __init__(self, me, debug_mode=False):
+        # Guards adding events. The consensus uses its own lock, so it never blocks adding events.
+        # Never acquire the lock while holding the consensus lock.
         self.lock = threading.RLock()
+        self.consensus_lock = threading.RLock()
         # Member: A reference to the current user. For convenience (e.g. signing)
         self.me = me
         self.debug_mode = debug_mode
@@ -28,36 +35,104 @@ class Hashgraph:
         if me is not None:
             self.known_members = {me.id: me}
 
-        # {event-hash => event}: Dictionary mapping hashes to events
-        self.lookup_table = {}
+        # {event-hash => event}: Dictionary mapping hashes to events - events ordered long ago are only kept in the
+        # database, see evict_events()
+        self.lookup_table = EventStore(self.restore_event)
+
+        # [event-hash]: All events in the order in which they were added (topological order), except for the archived
+        # ones (see prune()). Only ever appended to - pruning replaces the list, so that it can be read without the
+        # lock, see snapshot()
+        self.events = []
+
+        # The number of archived events which were removed from events
+        self.pruned_events_count = 0
+
+        # [member-id]: Creators of events in the order in which they were first seen
+        # The position of a member is used as index in the ancestry vectors of events
+        self.member_ids = []
+
+        # {member-id => index}: Position of each creator in member_ids
+        self.member_indices = {}
+
+        # [event-hash]: Events which were added but not yet processed by the consensus (in topological order)
+        self.events_for_consensus = deque()
+
+        # Set whenever events are added for the consensus
+        self.events_added = threading.Event()
 
         # {event-hash}: Events for which the final order has not yet been determined
         self.unordered_events = set()
 
-        # [event-hash]: Final order of events
-        self.ordered_events = []
+        # [event-hash]: Final order of events - the evicted ones at the beginning are pruned
+        self.ordered_events = PrunedList()
         self.next_ordered_event_idx_to_process = 0
 
+        # Hash chaining the hashes of all processed events in their final order, see process_ordered_events()
+        self.ordered_events_hash = ''
+
+        # {(event-hash, int)}: Money transactions which were denied (the event and the index of the transaction)
+        self.denied_transactions = set()
+
+        # The number of ordered events which were considered for being evicted from memory, see evict_events()
+        self.next_ordered_event_idx_to_evict = 0
+
+        # {event-hash}: Ordered events which were kept in memory because they were the heads of their creators
+        self.unevicted_heads = set()
+
+        # [event-hash]: Evicted events which couldn't be archived yet, see DB.flush()
+        self.unarchived_events = []
+
         self.idx = {}
 
         # {round-num}: rounds where fame is fully decided
         self.rounds_with_decided_fame = set()
 
+        # round-num: The next round used for finding the order of events (once its fame is decided)
+        self.next_round_to_order = 0
+
+        # round-num: The last round whose witnesses were pruned - its fame was decided, see prune()
+        self.pruned_round = -1
+
         # {round-num => {member-pk => event-hash}}:
         self.witnesses = defaultdict(dict)
 
-        # {event-hash => set(event-hash)}: Cache for event's self-children (used for fast fork check)
-        self.self_children_cache = defaultdict(set)
+        # {event-hash}: Witnesses of rounds that are not decided yet, whose fame is still undecided
+        self.undecided_witnesses = set()
+
+        # {event-hash => set(event-hash)}: Cache for the witnesses of the previous round a witness strongly sees
+        self.strongly_seen_witnesses = {}
+
+        # {member-id => [event-hash]}: The events of each member, indexed by height - the evicted ones at the
+        # beginning are pruned
+        self.member_chains = defaultdict(PrunedList)
+
+        # {member-id => event-hash}: The first event of each member (height 0), see consensus.py
+        self.first_events = {}
+
+        # {member-id => [event-hash]}: Events of members who forked which are not part of their chain
+        self.forked_events = defaultdict(list)
 
         # set(member-id): A set of member who forked. Members who forked have no visible events.
         self.fork_blacklist = set()
 
+        # {event-hash}: Events which were added or whose consensus changed since they were last stored, see DB.flush()
+        self.dirty_events = set()
+
+        # Set when enough events are dirty for storing them right away, see DBWriterThread
+        self.flush_needed = threading.Event()
+
+        # The last decided round of the latest stored checkpoint, see DB.flush()
+        self.checkpoint_round = -1
+
+        # Set when the hashgraph was replaced by a new one - it isn't stored any more, see DB.reset()
+        self.discarded = False
+
     @property
     def total_stake(self) -> int:
         """
         :return: The total stake in the hashgraph
         """
-        return sum([member.stake for _, member in self.known_members.items()])
+        return sum([member.stake for member in list(self.known_members.values())])
 
     @property
     def supermajority_stake(self) -> int:
@@ -66,33 +141,63 @@ class Hashgraph:
         """
         return int(math.floor(2 * self.total_stake / 3))
 
-    def get_unknown_events_of(self, member: Member) -> Dict[str, Event]:
+    def member_index(self, member_id: str) -> int:
         """
-        Returns the presumably unknown events of a given member, in the same format as lookup_table
-        :param member: The member for which to return unknown events
-        :return: Dictionary mapping hashes to events
+        Returns the index of an event creator (used in the ancestry vectors of events), assigning a new one if needed
+        :param member_id: The ID of the member
+        :return: The index of the member
         """
-        result = dict(self.lookup_table)
-        head = member.head
+        if member_id not in self.member_indices:
+            self.member_indices[member_id] = len(self.member_ids)
+            self.member_ids.append(member_id)
+        return self.member_indices[member_id]
 
-        if head is None:
-            return result
+    def index_height(self, event: Event) -> bool:
+        """
+        Adds an event to the chain of its creator (see member_chains)
+        :param event: The event - its self-parent must have been indexed before
+        :return: Whether the event is a fork, i.e. it doesn't continue the creator's chain
+        """
+        chain = self.member_chains[event.verify_key]
+        # The self-parent of the first event isn't known if the chain was pruned before loading it
+        if event.height == len(chain) and \
+                (event.height == 0 or chain[-1] in (event.parents.self_parent, None)):
+            chain.append(event.id)
+            if event.height == 0:
+                self.first_events[event.verify_key] = event.id
+            return False
+
+        self.forked_events[event.verify_key].append(event.id)
+        return True
 
-        to_visit = {head}
-        visited = set()
+    @property
+    def generation(self) -> int:
+        """
+        :return: The number of events added so far - it grows with every added event
+        """
+        return self.pruned_events_count + len(self.events)
 
-        while len(to_visit) > 0:
-            event_id = to_visit.pop()
-            if event_id not in visited:
-                event = result[event_id]
-                del result[event_id]
-                if event.parents.self_parent is not None:
-                    to_visit.add(event.parents.self_parent)
-                if event.parents.other_parent is not None:
-                    to_visit.add(event.parents.other_parent)
-                visited.add(event_id)
+    def snapshot(self) -> "HashgraphSnapshot":
+        """
+        Returns a read-only view of the current state. It can be used without holding the lock, e.g. for serializing
+        events while new events are being added
+        :return: The snapshot
+        """
+        with self.lock:
+            return HashgraphSnapshot(self)
 
-        return result
+    def get_known_heights(self) -> Dict[str, int]:
+        """
+        Returns the height of the latest known event by each member who didn't fork, see
+        HashgraphSnapshot.get_known_heights()
+        """
+        return self.snapshot().get_known_heights()
+
+    def get_unknown_events_of(self, member: Member) -> Dict[str, Event]:
+        """
+        Returns the presumably unknown events of a given member, see HashgraphSnapshot.get_unknown_events_of()
+        """
+        return self.snapshot().get_unknown_events_of(member)
 
     def add_own_event(self, event: Event, calculate_consensus: bool = False):
         """
@@ -110,45 +215,85 @@ class Hashgraph:
 
         # Only do consensus if this is the first event
         if calculate_consensus:
-            divide_rounds(self, [event])
-            decide_fame(self)
-            find_order(self)
-            self.process_ordered_events()
+            self.advance_consensus()
 
     def add_event(self, event: Event):
         # Set the event's correct height
         if event.parents.self_parent:
             event.height = self.lookup_table[event.parents.self_parent].height + 1
 
+        # Reuse the hashes and member IDs we already store, so that they don't need memory for every event
+        event.parents = Parents(*[None if parent_id is None else self.lookup_table[parent_id].id
+                                  for parent_id in event.parents])
+        event.verify_key = self.member_ids[self.member_index(event.verify_key)]
+
         # Add event to graph
         self.lookup_table[event.id] = event
+        self.events.append(event.id)
+
+        # The body was only needed for checking the ID and signature
+        event.release_body()
 
         # Update caches
-        self.unordered_events.add(event.id)
+        index_ancestry(self, event)
         if self.known_members[event.verify_key].head is None or \
                 event.height > self.lookup_table[self.known_members[event.verify_key].head].height:
             self.known_members[event.verify_key].head = event.id
-        if event.parents.self_parent is not None:
-            self.self_children_cache[event.parents.self_parent].add(event.id)
-            if len(self.self_children_cache[event.parents.self_parent]) > 1:
-                # We just added a fork
-                bptc.logger.warn("A fork was created! Blacklisting member and clearing visibility caches.")
+        if self.index_height(event) and event.verify_key not in self.fork_blacklist:
+            # We just added a fork
+            bptc.logger.warn("A fork was created! Blacklisting member.")
+
+            # Blacklist the member who forked
+            self.fork_blacklist.add(event.verify_key)
+
+        # Hand the event over to the consensus
+        self.events_for_consensus.append(event.id)
+        self.events_added.set()
+
+    def advance_consensus(self) -> None:
+        """
+        Figures out rounds, fame, order, etc. for all events that were added since the last run
+        :return: None
+        """
+        with self.consensus_lock:
+            events = []
+            while len(self.events_for_consensus) > 0:
+                events.append(self.lookup_table[self.events_for_consensus.popleft()])
+            if len(events) == 0:
+                return
 
-                # Blacklist the member who forked
-                self.fork_blacklist.add(event.verify_key)
+            for event in events:
+                self.unordered_events.add(event.id)
 
-                # Visibility for events could have changed - throw away the caches
-                for e in self.lookup_table.values():
-                    e.can_see_cache.clear()
+            undecided_witnesses = set(self.undecided_witnesses)
+            ordered_events_count = len(self.ordered_events)
+
+            divide_rounds(self, events)
+            decide_fame(self)
+            find_order(self)
+            self.process_ordered_events()
+
+            # Remember what needs to be stored: the new events, witnesses whose fame was decided and ordered events
+            self.dirty_events.update(event.id for event in events)
+            self.dirty_events |= undecided_witnesses - self.undecided_witnesses
+            self.dirty_events.update(self.ordered_events[ordered_events_count:])
+            if len(self.dirty_events) >= bptc.db_flush_threshold:
+                self.flush_needed.set()
 
     def process_events(self, from_member: Member, events: Dict[str, Event]) -> None:
         """
-        Processes a list of events
+        Processes a list of events. The consensus for the new events is calculated in the background,
+        see advance_consensus()
         :param from_member: The member from whom the events were received
         :param events: The events to be processed
         :return: None
         """
-        events = copy.deepcopy(events)
+        # Events we already know are dropped before copying and verifying them
+        new_events = {}
+        for event_id, event in events.items():
+            if not self.knows_event(event_id, event.verify_key, event.parents.self_parent, new_events):
+                new_events[event_id] = event
+        events = copy.deepcopy(new_events)
         bptc.logger.debug("Processing {} events from {}...".format(len(events), from_member.verify_key[:6]))
 
         # Only deal with valid events
@@ -159,31 +304,24 @@ class Hashgraph:
         self.learn_members_from_events(events)
 
         # Add all new events in topological order and check parent pointer
-        new_events = {}
+        # Events with unknown parents are skipped (and so are their descendants), the rest of the data is still used -
+        # it may have been received from several members at once
         for event in events_toposorted:
-            if event.id not in self.lookup_table:
+            if not self.knows_event(event.id, event.verify_key, event.parents.self_parent):
                 if event.parents.self_parent is not None and event.parents.self_parent not in self.lookup_table:
-                    bptc.logger.error('Self parent {} of {} not known. Ignore all data.'.
+                    bptc.logger.error('Self parent {} of {} not known. Ignore event.'.
                                       format(event.parents.self_parent[:6], event.id[:6]))
-                    return
+                    continue
                 if event.parents.other_parent is not None and event.parents.other_parent not in self.lookup_table:
-                    bptc.logger.error('Other parent {} of {} not known. Ignore all data'.
-                                         format(event.parents.other_parent[:6], event.id[:6]))
-                    return
+                    bptc.logger.error('Other parent {} of {} not known. Ignore event.'.
+                                      format(event.parents.other_parent[:6], event.id[:6]))
+                    continue
 
-                new_events[event.id] = event
                 self.add_event(event)
 
         # Create a new event for the gossip
         event = Event(self.me.verify_key, None, Parents(self.me.head, from_member.head))
         self.add_own_event(event)
-        new_events[event.id] = event
-
-        # Figure out fame, order, etc.
-        divide_rounds(self, toposort(new_events))
-        decide_fame(self)
-        find_order(self)
-        self.process_ordered_events()
 
         # Debug mode writes the DB to a file every 100 events.
         if self.debug_mode:
@@ -196,6 +334,25 @@ class Hashgraph:
                 DB.save(self, temp=True)
                 self.debug_mode = (len(self.lookup_table) // 100) * 100
 
+    def knows_event(self, event_id: str, verify_key: str, self_parent: Optional[str],
+                    new_event_ids: Container[str] = ()) -> bool:
+        """
+        Checks whether an event was added, e.g. before parsing and verifying a received event. New events are mostly
+        recognized without reading the database (see EventStore): an event whose self-parent is new or the head of its
+        creator wasn't added - the head would be higher
+        :param event_id: The hash of the event
+        :param verify_key: The ID of its creator
+        :param self_parent: The hash of its self-parent
+        :param new_event_ids: Hashes of events which are known to be new, e.g. the ones received before it [Optional]
+        :return: Whether the event was added
+        """
+        if self.lookup_table.is_resident(event_id):
+            return True
+        member = self.known_members.get(verify_key)
+        if self_parent in new_event_ids or self_parent == (member.head if member is not None else None):
+            return False
+        return event_id in self.lookup_table
+
     def learn_members_from_events(self, events: Dict[str, Event]) -> None:
         """
         Goes through a list of events and learns their creators if they are not already known
@@ -206,13 +363,35 @@ class Hashgraph:
             if event.verify_key not in self.known_members:
                 self.known_members[event.verify_key] = Member(event.verify_key, None)
 
+    def get_checkpoint(self) -> Dict:
+        """
+        Returns the state after the last decided round, from which the hashgraph can be restored without verifying
+        and replaying the events ordered so far (see DB.load_hashgraph()). The consensus lock must be held
+        :return: Dict containing the last decided round ('round'), the number and hash of the ordered events
+                 ('ordered_events', 'ordered_events_hash', see process_ordered_events()), the balance and name of
+                 each member ('members'), the denied transactions ('denied_transactions'), the members who forked
+                 ('fork_blacklist') and the last pruned round ('pruned_round')
+        """
+        return {
+            'round': self.next_round_to_order - 1,
+            'ordered_events': self.next_ordered_event_idx_to_process,
+            'ordered_events_hash': self.ordered_events_hash,
+            'members': {member.id: {'balance': member.account_balance, 'name': member.name}
+                        for member in list(self.known_members.values())},
+            'denied_transactions': sorted(self.denied_transactions),
+            'fork_blacklist': sorted(self.fork_blacklist),
+            'pruned_round': self.pruned_round
+        }
+
     def process_ordered_events(self):
         for event_id in self.ordered_events[self.next_ordered_event_idx_to_process:len(self.ordered_events)]:
             event = self.lookup_table[event_id]
+            # Chained, so that the hash can be continued after loading without the archived events
+            self.ordered_events_hash = hashlib.sha512((self.ordered_events_hash + event_id).encode('UTF-8')).hexdigest()
             if event.data is None:
                 continue
 
-            for transaction in event.data:
+            for i, transaction in enumerate(event.data):
                 sender = self.known_members[event.verify_key]
                 if isinstance(transaction, MoneyTransaction):
                     receiver = self.known_members[transaction.receiver]
@@ -220,6 +399,7 @@ class Hashgraph:
                     # Check if the sender has the funds
                     if sender.account_balance < transaction.amount or transaction.amount < 0:
                         transaction.status = TransactionStatus.DENIED
+                        self.denied_transactions.add((event_id, i))
                     else:
                         sender.account_balance -= transaction.amount
                         receiver.account_balance += transaction.amount
@@ -229,6 +409,92 @@ class Hashgraph:
 
         self.next_ordered_event_idx_to_process = len(self.ordered_events)
 
+    def restore_event(self, event: Event) -> None:
+        """
+        Restores the status of the money transactions of a processed event which was read from the database (it
+        isn't stored), see process_ordered_events()
+        :param event: The event
+        :return: None
+        """
+        for i, transaction in enumerate(event.data or []):
+            if isinstance(transaction, MoneyTransaction):
+                if (event.id, i) in self.denied_transactions:
+                    transaction.status = TransactionStatus.DENIED
+                else:
+                    transaction.status = TransactionStatus.CONFIRMED
+
+    @property
+    def horizon_round(self) -> int:
+        """
+        :return: The last round whose events are evicted from memory once they are stored, see evict_events() - it is
+                 covered by the latest stored checkpoint, so that the archived events never need to be replayed
+        """
+        return min(self.next_round_to_order - 1 - bptc.event_horizon_rounds, self.checkpoint_round)
+
+    def evict_events(self) -> List[str]:
+        """
+        Evicts the events which were ordered at least bptc.event_horizon_rounds rounds ago from memory, see EventStore.
+        They must have been stored (see DB.flush()). The heads of members are kept until their creators add newer
+        events, as they are still used as parents
+        :return: The hashes of the evicted events
+        """
+        with self.consensus_lock:
+            last_round = self.horizon_round
+            heads = set(member.head for member in list(self.known_members.values()))
+            evicted_events = []
+
+            for event_id in [e for e in self.unevicted_heads if e not in heads]:
+                self.unevicted_heads.remove(event_id)
+                self.lookup_table.evict(event_id)
+                evicted_events.append(event_id)
+
+            # Events are evicted in their final order - stop at the first one which is too new or wasn't stored yet
+            while self.next_ordered_event_idx_to_evict < self.next_ordered_event_idx_to_process:
+                event_id = self.ordered_events[self.next_ordered_event_idx_to_evict]
+                if self.lookup_table.resident[event_id].round_received > last_round or event_id in self.dirty_events:
+                    break
+                if event_id in heads:
+                    self.unevicted_heads.add(event_id)
+                else:
+                    self.lookup_table.evict(event_id)
+                    evicted_events.append(event_id)
+                self.next_ordered_event_idx_to_evict += 1
+
+            return evicted_events
+
+    def prune(self, archived_events: Iterable[str]) -> None:
+        """
+        Removes archived events (see DB.flush()) from the lists of events and the evicted ones from the beginning of
+        the chains and the final order. Forgets the witnesses of the rounds up to horizon_round - their fame is
+        decided and the consensus of later rounds doesn't look at them. This way, the memory needed by a node stops
+        growing with the history
+        :param archived_events: The hashes of the events which were evicted and archived
+        :return: None
+        """
+        archived_events = set(archived_events)
+        with self.lock, self.consensus_lock:
+            is_resident = self.lookup_table.is_resident
+
+            if archived_events:
+                events = [event_id for event_id in self.events if event_id not in archived_events]
+                self.pruned_events_count += len(self.events) - len(events)
+                self.events = events
+
+            for chain in list(self.member_chains.values()):
+                height = chain.offset
+                while height < len(chain) - 1 and not is_resident(chain[height]):
+                    height += 1
+                chain.prune(height)
+
+            self.ordered_events.prune(self.next_ordered_event_idx_to_evict)
+
+            last_round = self.horizon_round
+            for r in [r for r in self.witnesses if r <= last_round]:
+                for witness_id in self.witnesses.pop(r).values():
+                    self.strongly_seen_witnesses.pop(witness_id, None)
+            self.rounds_with_decided_fame = set(r for r in self.rounds_with_decided_fame if r > last_round)
+            self.pruned_round = max(self.pruned_round, last_round)
+
     def parse_transaction(self, event, transaction, plain=False):
         receiver = self.known_members[transaction.receiver].formatted_name if \
             transaction.receiver in self.known_members else transaction.receiver
@@ -264,8 +530,7 @@ class Hashgraph:
     def get_relevant_transactions(self, plain=False, show_all=False):
         # Load transactions belonging to this member
         transactions = []
-        events = list(self.lookup_table.values())
-        for e in events:
+        for e in self.snapshot().events:
             for t in e.data or []:
                 if isinstance(t, MoneyTransaction):
                     if show_all or self.me.to_verifykey_string() in [e.verify_key, t.receiver]:
@@ -273,15 +538,127 @@ class Hashgraph:
         return sorted(transactions, key=lambda x: x['time'], reverse=True)
 
 
+class HashgraphSnapshot:
+    """
+    A read-only view of a hashgraph, which doesn't need the lock of the hashgraph
+
+    It only contains the events which were added when it was taken. This works without copying them, because the
+    bodies of events and the lists of events (Hashgraph.events, member_chains and forked_events) are never changed
+    after adding events - they are only appended to, or replaced when pruning. The consensus of events may still
+    change. Pruned events are read from the database.
+    """
+
+    def __init__(self, hashgraph: Hashgraph):
+        # Hashgraph: The hashgraph - must be locked while creating the snapshot
+        self.hashgraph = hashgraph
+
+        # int: The number of events in the snapshot, see Hashgraph.generation
+        self.generation = hashgraph.generation
+
+        # [event-hash]: The events which weren't archived - only the first ones belong to the snapshot
+        self.unarchived_events = hashgraph.events
+        self.unarchived_events_count = len(hashgraph.events)
+
+        # {member-id => (int, int)}: Number of events in the chain and number of forked events of each member
+        self.chain_lengths = {member_id: (len(chain), len(hashgraph.forked_events.get(member_id, ())))
+                              for member_id, chain in hashgraph.member_chains.items()}
+
+        # frozenset(member-id): Members who forked
+        self.fork_blacklist = frozenset(hashgraph.fork_blacklist)
+
+        # [Member]: All members we know
+        self.known_members = list(hashgraph.known_members.values())
+
+    @property
+    def events(self) -> Iterator[Event]:
+        """
+        :return: Iterator over all events of the snapshot - the archived ones first, then the others in topological
+                 order
+        """
+        unarchived_events = self.unarchived_events[:self.unarchived_events_count]
+        if self.hashgraph.pruned_events_count > 0:
+            # Events archived since the snapshot was taken are part of both
+            unarchived_event_ids = set(unarchived_events)
+            for event in self.hashgraph.lookup_table.iter_archived_events():
+                if event.id not in unarchived_event_ids:
+                    yield event
+        yield from self.hashgraph.lookup_table.iter_events(unarchived_events)
+
+    def get_known_heights(self) -> Dict[str, int]:
+        """
+        Returns the height of the latest known event by each member who didn't fork
+        Other members only need to be sent the events above these heights
+        :return: Dictionary mapping member IDs to heights
+        """
+        return {member_id: chain_length - 1 for member_id, (chain_length, _) in self.chain_lengths.items()
+                if member_id not in self.fork_blacklist}
+
+    def get_unknown_events_of(self, member: Member) -> Dict[str, Event]:
+        """
+        Returns the presumably unknown events of a given member, in the same format as lookup_table
+        :param member: The member for which to return unknown events
+        :return: Dictionary mapping hashes to events
+        """
+        # The member knows all ancestors of its latest event
+        heights = {}
+        head = self.hashgraph.lookup_table.get(member.head) if member.head is not None else None
+        if head is not None:
+            heights = {self.hashgraph.member_ids[i]: height for i, height in enumerate(head.last_ancestors)}
+
+        # The member might have told us that it knows newer events
+        if member.known_heights is not None:
+            for member_id, height in member.known_heights.items():
+                heights[member_id] = max(height, heights.get(member_id, -1))
+
+        return self.get_events_above(heights)
+
+    def get_events_above(self, heights: Dict[str, int]) -> Dict[str, Event]:
+        """
+        Returns the events that are higher than the given heights of their creators
+        All events of members without a height and of members who forked are returned (heights are
+        ambiguous for them)
+        :param heights: Dictionary mapping member IDs to heights, see get_known_heights()
+        :return: Dictionary mapping hashes to events
+        """
+        event_ids = []
+        result = {}
+        for member_id, (chain_length, forked_length) in self.chain_lengths.items():
+            chain = self.hashgraph.member_chains[member_id]
+            start = 0 if member_id in self.fork_blacklist else heights.get(member_id, -1) + 1
+            chain_event_ids = chain[start:chain_length]
+            if len(chain_event_ids) < chain_length - start:
+                # The beginning of the chain was pruned
+                for event in self.hashgraph.lookup_table.read_chain(
+                        member_id, start, chain_length - len(chain_event_ids)):
+                    result[event.id] = event
+            event_ids += chain_event_ids
+            if member_id in self.fork_blacklist:
+                event_ids += self.hashgraph.forked_events.get(member_id, [])[:forked_length]
+
+        result.update(zip(event_ids, self.hashgraph.lookup_table.iter_events(event_ids)))
+        return result
+
+
 def filter_valid_events(events: Dict[str, Event]) -> Dict[str, Event]:
     """
     Goes through a dict of events and returns a dict containing only the valid ones
+    The IDs of the events are checked against their bodies and the signatures of big dicts are verified in parallel
     :param events: The dict to be filtered
     :return: A dict containing only valid events
     """
-    result = dict()
+    items = []
     for event_id, event in events.items():
-        if event.has_valid_signature:
+        if len(event.time.encode('UTF-8')) > MAX_TIME_LENGTH:
+            bptc.logger.warn("Event had too long time: {}".format(event))
+        elif event_id == event.id and event.has_valid_id:
+            items.append((event_id, event))
+        else:
+            bptc.logger.warn("Event had invalid ID: {}".format(event))
+    valid = verify_signatures([(event.signature, event.verify_key, event.body_bytes) for _, event in items])
+
+    result = dict()
+    for (event_id, event), is_valid in zip(items, valid):
+        if is_valid:
             result[event_id] = event
         else:
             bptc.logger.warn("Event had invalid signature: {}".format(event))
@@ -41,6 +41,14 @@ class Member:
         # The account balance of this member
         self.account_balance = bptc.new_member_account_balance
 
+        # {member-id => height}: Heights of the latest events this member told us it knows (per creator)
+        # None until the member advertised them
+        self.known_heights = None
+
+        # [str]: Features of the push protocol this member told us it supports (e.g. compression codecs)
+        # Empty for members running older versions
+        self.capabilities = []
+
         # How often pushing to this member has failed
         # Is reset when the Address changes
         self.push_fail_count = 0
@@ -1,13 +1,15 @@
 import queue
-from random import choice
 from typing import Dict, List
 import random
 import json
+import lzma
+import struct
+import zlib
 from bptc.data.event import Event, Parents
 from bptc.data.hashgraph import Hashgraph
 from bptc.data.transaction import MoneyTransaction, PublishNameTransaction
-from bptc.data.db import DB
-from bptc.protocols.push_protocol import PushClientFactory
+from bptc.data.db import DB, DBWriterThread
+from bptc.protocols.push_protocol import PushClientFactory, FRAMED
 import time
 from datetime import datetime
 import threading
@@ -18,6 +20,9 @@ import bptc
 from bptc.data.member import Member
 from bptc.protocols.push_protocol import PushServerFactory
 from bptc.protocols.pull_protocol import PullServerFactory
+from bptc.protocols.binary_format import BINARY, encode_message, decode_message, is_binary_message
+from bptc.utils.compression import compress, decompress, SUPPORTED_CODECS
+from bptc.utils.fragment_cache import fragment_cache
 
 
 class Network:
@@ -28,17 +33,35 @@ class Network:
         # The current hashgraph
         self.hashgraph = hashgraph
 
-        # the thread that frequently pushes
-        self.background_push_client_thread = None
+        # the scheduler that frequently pushes
+        self.gossip_scheduler = None
 
         # the thread that processes the pushes from other members
         self.background_push_server_thread = PushingServerThread(self)
         self.background_push_server_thread.daemon = True
         self.background_push_server_thread.start()
 
+        # the thread that calculates the consensus for new events
+        self.background_consensus_thread = ConsensusThread(self)
+        self.background_consensus_thread.daemon = True
+        self.background_consensus_thread.start()
+
+        # the thread that stores the hashgraph
+        self.background_db_thread = DBWriterThread(self)
+        self.background_db_thread.daemon = True
+        self.background_db_thread.start()
+
+        # {member-id => PushClientFactory}: Persistent connections to members who support framed messages
+        # Only used in the reactor thread
+        self.push_connections = {}
+
         # Statistics
         self.last_push_sent = None
         self.last_push_received = None
+        self.received_events_count = 0
+        self.duplicate_events_count = 0
+        self.dropped_pushes_count = 0
+        self.merged_pushes_count = 0
 
         # Create first own event
         if create_initial_event:
@@ -51,22 +74,36 @@ class Network:
     def reset(self):
         """Delete the hashgraph and create a new one."""
 
-        DB.reset()
         new_me = Member.create()
         new_me.address = IPv4Address("TCP", bptc.ip, bptc.port)
         new_hashgraph = Hashgraph(new_me)
-        self.hashgraph = new_hashgraph
+        # Replace the hashgraph before clearing the database, so that the old one isn't stored again
+        old_hashgraph, self.hashgraph = self.hashgraph, new_hashgraph
+        DB.reset(old_hashgraph)
         self.hashgraph.add_own_event(Event(self.hashgraph.me.verify_key, None, Parents(None, None)), True)
         self.last_push_sent = None
         self.last_push_received = None
+        self.received_events_count = 0
+        self.duplicate_events_count = 0
+        self.dropped_pushes_count = 0
+        self.merged_pushes_count = 0
+
+    @property
+    def duplicate_events_rate(self) -> float:
+        """The share of received events which were already known."""
+        if self.received_events_count == 0:
+            return 0
+        return self.duplicate_events_count / self.received_events_count
 
     def push_to(self, ip, port) -> None:
         """Push to the specified network address."""
 
-        with self.hashgraph.lock:
-            data_string = self.generate_data_string(self.hashgraph.me,
-                                                    self.hashgraph.lookup_table,
-                                                    filter_members_with_address(self.hashgraph.known_members.values()))
+        # Serialize without holding the lock, so that events can be added meanwhile
+        snapshot = self.hashgraph.snapshot()
+        data_string = self.generate_data_string(self.hashgraph.me,
+                                                {event.id: event for event in snapshot.events},
+                                                filter_members_with_address(snapshot.known_members),
+                                                snapshot.get_known_heights())
 
         factory = PushClientFactory(data_string, network=self)
 
@@ -76,13 +113,17 @@ class Network:
         threads.blockingCallFromThread(reactor, push)
 
     @staticmethod
-    def generate_data_string(me, events, members):
-        """Generates a string out of events and members for transferring it over the network."""
-
-        serialized_events = {}
-        if events is not None:
-            for event_id, event in events.items():
-                serialized_events[event_id] = event.to_dict()
+    def generate_data_string(me, events, members, heights=None, binary=False):
+        """
+        Generates a string out of events and members for transferring it over the network
+        :param me: The sending member
+        :param events: The events to send
+        :param members: The members to send
+        :param heights: The heights of the latest events the sender knows per creator (see
+                        Hashgraph.get_known_heights()) - the receiver only sends events above them in return
+        :param binary: Whether to use the binary format (see binary_format.py) instead of JSON
+        :return: The encoded string
+        """
 
         serialized_members = []
         if members is not None:
@@ -90,26 +131,51 @@ class Network:
                 if member.id is not me.verify_key:
                     serialized_members.append(member.to_dict())
 
-        data_to_send = {
-            'from': {
-                'verify_key': me.verify_key,
-                'listening_port': me.address.port
-            },
-            'events': serialized_events,
-            'members': serialized_members
+        sender = {
+            'verify_key': me.verify_key,
+            'listening_port': me.address.port,
+            'capabilities': SUPPORTED_CODECS + [FRAMED, BINARY]
         }
+        if heights is not None:
+            sender['heights'] = heights
+
+        if binary:
+            try:
+                return encode_message(sender, events or {}, serialized_members)
+            except (ValueError, struct.error) as e:
+                # Every event can be sent as JSON
+                bptc.logger.warn('Could not encode the push in the binary format, sending JSON: {}'.format(e))
+
+        # The events are serialized separately, so that they can be cached
+        serialized_events = []
+        if events is not None:
+            for event_id, event in events.items():
+                serialized_events.append(fragment_cache.get(('json', event_id), partial(serialize_event, event_id, event)))
 
-        return json.dumps(data_to_send).encode('UTF-8')
+        return b''.join([b'{"from": ', json.dumps(sender).encode('UTF-8'),
+                         b', "events": {', b', '.join(serialized_events),
+                         b'}, "members": ', json.dumps(serialized_members).encode('UTF-8'), b'}'])
 
     def push_to_member(self, member: Member, ignore_for_statistics=False) -> None:
         """Push to the specified member."""
 
         bptc.logger.debug('Push to {}... ({}, {})'.format(member.verify_key[:6], member.address.host, member.address.port))
 
-        with self.hashgraph.lock:
-            data_string = self.generate_data_string(self.hashgraph.me,
-                                                    self.hashgraph.get_unknown_events_of(member),
-                                                    filter_members_with_address(self.hashgraph.known_members.values()))
+        # Serialize without holding the lock, so that events can be added meanwhile
+        snapshot = self.hashgraph.snapshot()
+        capabilities = member.capabilities
+        data_string = self.generate_data_string(self.hashgraph.me,
+                                                snapshot.get_unknown_events_of(member),
+                                                filter_members_with_address(snapshot.known_members),
+                                                snapshot.get_known_heights(),
+                                                BINARY in capabilities)
+
+        # Only members who told us which codecs they support get compressed data
+        data_string = compress(data_string, capabilities)
+
+        if FRAMED in capabilities:
+            threads.blockingCallFromThread(reactor, self.push_framed, member, data_string)
+            return
 
         if not ignore_for_statistics:
             factory = PushClientFactory(data_string, network=self, receiver=member)
@@ -122,22 +188,41 @@ class Network:
 
         threads.blockingCallFromThread(reactor, push)
 
-    def push_to_random(self) -> None:
+    def push_framed(self, member: Member, data_string: bytes) -> None:
         """
-        Pushes to a random, known member
+        Sends a push over the persistent connection to a member, connecting first if necessary
+        Must be called in the reactor thread
+        :param member: The receiver
+        :param data_string: The data to push
         :return: None
         """
-        with self.hashgraph.lock:
-            filtered_known_members = [m for key, m in self.hashgraph.known_members.items()
-                                      if key != self.hashgraph.me.verify_key
-                                      and m.address is not None
-                                      and key not in self.hashgraph.fork_blacklist]
-
-        if filtered_known_members:
-            member = choice(filtered_known_members)
-            self.push_to_member(member)
-        else:
-            bptc.logger.debug("I don't know any other members!")
+        if member.address is None:
+            return
+
+        factory = self.push_connections.get(member.id)
+        if factory is not None and factory.receiver_address != (member.address.host, member.address.port):
+            # The member moved
+            factory.close()
+            factory = None
+
+        if factory is None:
+            factory = PushClientFactory(None, network=self, receiver=member, framed=True)
+            self.push_connections[member.id] = factory
+            reactor.connectTCP(member.address.host, member.address.port, factory)
+
+        factory.send(data_string)
+
+    def get_push_targets(self) -> List[Member]:
+        """
+        Returns the known members we can push to - without the lock of the hashgraph, as it is called in the reactor
+        thread (see GossipScheduler)
+        :return: The members
+        """
+        hashgraph = self.hashgraph
+        return [m for key, m in list(hashgraph.known_members.items())
+                if key != hashgraph.me.verify_key
+                and m.address is not None
+                and key not in hashgraph.fork_blacklist]
 
     def send_transaction(self, amount: int, comment: str, receiver: Member) -> Event:
         """
@@ -174,22 +259,81 @@ class Network:
 
         try:
             self.background_push_server_thread.q.put((data_string, peer), block=False)
-        except:
-            pass
+        except queue.Full:
+            self.dropped_pushes_count += 1
+            bptc.logger.debug('Dropped a push from {} - too many pushes are waiting'.format(peer))
+
+    @property
+    def push_queue_depth(self) -> int:
+        """The number of received pushes waiting to be processed."""
+        return self.background_push_server_thread.q.qsize()
 
     def process_data_string(self, data_string, peer):
         """Process a received data string."""
+        self.process_data_strings([(data_string, peer)])
+
+    def process_data_strings(self, data_strings) -> None:
+        """
+        Processes several received data strings at once - all of their events are processed in a single batch
+        :param data_strings: List of (data string, peer) tuples
+        :return: None
+        """
+        events = {}
+        members = {}
+        # The latest member who sent events
+        from_member = None
+
+        for data_string, peer in data_strings:
+            received = self.parse_data_string(data_string, peer)
+            if received is None:
+                continue
+            sender, sender_events, sender_members = received
+            if sender_events is not None:
+                from_member = sender
+                events.update(sender_events)
+                with self.hashgraph.lock:
+                    self.store_member(sender)
+            for member in sender_members:
+                members.setdefault(member.id, member)
+
+        if from_member is not None:
+            self.process_events(from_member, events)
+
+        # Check if the senders sent any members
+        if len(members) > 0:
+            bptc.logger.debug('- Received {} members'.format(len(members)))
+
+            self.receive_members_callback(list(members.values()))
+
+    def parse_data_string(self, data_string, peer):
+        """
+        Parses a received data string
+        :param data_string: The data string as received (see compression.py)
+        :param peer: The address from which it was received
+        :return: Tuple containing the sender, its events we didn't know yet (None if it didn't send any events) and
+                 the members it sent - None if the data string is invalid or was sent by ourselves
+        """
+
+        try:
+            data_string = decompress(data_string, bptc.push_max_decompressed_size)
+        except (zlib.error, lzma.LZMAError, ValueError) as err:
+            bptc.logger.error('Failed parsing input: {}... [length={}] \n\n Error message: {}'.format(
+                data_string[:100], len(data_string), err))
+            return None
 
-        # Decode received JSON data
+        # Decode received data - events we already know are skipped by the binary format
         try:
-            received_data = json.loads(data_string)
+            if is_binary_message(data_string):
+                received_data = decode_message(data_string, self.hashgraph.knows_event)
+            else:
+                received_data = json.loads(data_string)
         except:
-            bptc.logger.warn("Could not parse JSON message")
-            return
+            bptc.logger.warn("Could not parse message")
+            return None
 
         # Ignore pushes from yourself (should only happen once after the client is started)
         if received_data['from']['verify_key'] == self.me.verify_key:
-            return
+            return None
 
         # Log
         self.last_push_received = datetime.now().isoformat()
@@ -201,25 +345,51 @@ class Network:
         from_member.address = peer
         from_member.address.port = from_member_listening_port
 
+        # Remember which events the sender knows, so that we only push newer ones to it,
+        # and which features of the push protocol it supports (Older versions don't send them)
+        from_member_heights = received_data['from'].get('heights')
+        if from_member_heights is not None and not (
+                isinstance(from_member_heights, dict) and
+                all(isinstance(k, str) and type(v) is int for k, v in from_member_heights.items())):
+            bptc.logger.warn('Ignoring invalid heights from {}'.format(from_member_id))
+            from_member_heights = None
+        from_member.capabilities = received_data['from'].get('capabilities', [])
+        with self.hashgraph.lock:
+            known_from_member = self.hashgraph.known_members.get(from_member_id)
+            if known_from_member is not None:
+                known_from_member.capabilities = from_member.capabilities
+            if from_member_heights is not None:
+                from_member.known_heights = from_member_heights
+                if known_from_member is not None:
+                    known_from_member.known_heights = from_member_heights
+
         # Check if the sender sent any events
-        s_events = received_data['events']
-        if len(s_events) > 0:
+        if 'event_count' in received_data:
+            events, event_count = received_data['events'], received_data['event_count']
+        else:
+            # Skip events we already know before parsing and verifying them
             events = {}
-            for event_id, dict_event in s_events.items():
-                events[event_id] = Event.from_dict(dict_event)
-
-            bptc.logger.debug('- Received {} events'.format(len(events.items())))
-
-            self.process_events(from_member, events)
+            for event_id, dict_event in received_data['events'].items():
+                try:
+                    if not self.hashgraph.knows_event(event_id, dict_event['verify_key'], dict_event['parents'][0],
+                                                      events):
+                        events[event_id] = Event.from_dict(dict_event, event_id)
+                except (ValueError, TypeError, KeyError, IndexError, OverflowError):
+                    # E.g. a time which can't be parsed - the event couldn't be valid anyway
+                    bptc.logger.warn('Could not parse event {}'.format(event_id[:6]))
+            event_count = len(received_data['events'])
+
+        if event_count > 0:
+            self.received_events_count += event_count
+            self.duplicate_events_count += event_count - len(events)
+            bptc.logger.debug('- Received {} events ({} already known)'.format(event_count,
+                                                                                event_count - len(events)))
+        else:
+            events = None
 
-        # Check if the sender sent any members
-        s_members = received_data['members']
-        if len(s_members) > 0:
-            members = [Member.from_dict(m) for m in s_members]
+        members = [Member.from_dict(m) for m in received_data['members']]
 
-            bptc.logger.debug('- Received {} members'.format(len(members)))
-
-            self.receive_members_callback(members)
+        return from_member, events, members
 
     def process_events(self, from_member: Member, events: Dict[str, Event]) -> None:
         """
@@ -228,17 +398,26 @@ class Network:
         :param events: The list of events
         :return: None
         """
-        # Store/Update member
         with self.hashgraph.lock:
-            if from_member.id in self.hashgraph.known_members:
-                self.hashgraph.known_members[from_member.id].address = from_member.address
-                from_member = self.hashgraph.known_members[from_member.id]
-            else:
-                self.hashgraph.known_members[from_member.id] = from_member
+            from_member = self.store_member(from_member)
 
             # Let the hashgraph process the events
             self.hashgraph.process_events(from_member, events)
 
+    def store_member(self, member: Member) -> Member:
+        """
+        Stores a member who contacted us or updates its address if it is already known
+        The lock of the hashgraph must be held
+        :param member: The member
+        :return: The stored member
+        """
+        if member.id in self.hashgraph.known_members:
+            self.hashgraph.known_members[member.id].address = member.address
+            return self.hashgraph.known_members[member.id]
+
+        self.hashgraph.known_members[member.id] = member
+        return member
+
     def receive_members_callback(self, members: List[Member]) -> None:
         """
         Used as a callback when member are received from the outside
@@ -253,30 +432,110 @@ class Network:
                     self.hashgraph.known_members[member.id].address = member.address
 
     def start_push_thread(self) -> None:
-        """Start the thread responsible for frequent pushing."""
+        """Start frequent pushing, see GossipScheduler."""
 
-        self.background_push_client_thread = PushingClientThread(self)
-        self.background_push_client_thread.daemon = True
-        self.background_push_client_thread.start()
+        if self.gossip_scheduler is not None:
+            self.stop_push_thread()
+        self.gossip_scheduler = GossipScheduler(self)
+        reactor.callFromThread(self.gossip_scheduler.start)
 
     def stop_push_thread(self) -> None:
-        """Stop the thread responsible for frequent pushing."""
+        """Stop frequent pushing."""
+
+        if self.gossip_scheduler is not None:
+            reactor.callFromThread(self.gossip_scheduler.stop)
+            self.gossip_scheduler = None
+
+
+class GossipScheduler:
+    """
+    Frequently pushes to several random members at once. Runs in the reactor thread - the pushes themselves are
+    prepared in the reactor's thread pool.
 
-        self.background_push_client_thread.stop()
+    The interval between pushes adapts to the state of the hashgraph: it is shortened while many events wait for
+    their order (see push_backlog_threshold) and grows while no new events arrive, so that idle members don't
+    keep pushing at full rate.
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.interval = bptc.push_waiting_time_mu
+        # The pending call of tick()
+        self.call = None
+        # {member-id}: Members to whom a push is being prepared or sent
+        self.pushing = set()
+        # The generation of the hashgraph during the last tick, see Hashgraph.generation
+        self.last_generation = None
+
+    def start(self) -> None:
+        self.tick()
+
+    def stop(self) -> None:
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def tick(self) -> None:
+        """Pushes to random members and schedules the next tick."""
+        targets = [m for m in self.network.get_push_targets() if m.id not in self.pushing]
+        if targets:
+            for member in random.sample(targets, min(bptc.push_fanout, len(targets))):
+                self.push(member)
+        elif not self.pushing:
+            bptc.logger.debug("I don't know any other members!")
 
+        self.interval = self.next_interval()
+        self.call = reactor.callLater(max(random.normalvariate(self.interval, bptc.push_waiting_time_sigma), 0),
+                                      self.tick)
 
-class PushingClientThread(threading.Thread):
-    """Thread responsible for frequent pushing to random members."""
+    def push(self, member: Member) -> None:
+        self.pushing.add(member.id)
+        d = threads.deferToThread(self.network.push_to_member, member)
+        d.addErrback(lambda failure: bptc.logger.error('Push to {} failed: {}'.format(
+            member.verify_key[:6], failure.getErrorMessage())))
+        d.addBoth(lambda _: self.pushing.discard(member.id))
+
+    def next_interval(self) -> float:
+        """
+        :return: The time until the next tick
+        """
+        hashgraph = self.network.hashgraph
+        idle = hashgraph.generation == self.last_generation
+        self.last_generation = hashgraph.generation
+
+        if len(hashgraph.unordered_events) > bptc.push_backlog_threshold * len(hashgraph.known_members):
+            # Spread the new events faster, so that their order is found sooner
+            return max(self.interval / 2, bptc.push_waiting_time_min)
+        if idle:
+            # No events were received or created since the last tick
+            return min(self.interval * 2, bptc.push_waiting_time_max)
+        return bptc.push_waiting_time_mu
+
+
+class PushingServerThread(threading.Thread):
+    """Thread responsible for processing the received pushes."""
 
     def __init__(self, network):
-        super(PushingClientThread, self).__init__()
+        super(PushingServerThread, self).__init__()
         self.network = network
         self._stop_event = threading.Event()
+        self.q = queue.Queue(maxsize=bptc.push_queue_size)
 
     def run(self):
         while not self.stopped():
-            self.network.push_to_random()
-            time.sleep(max(random.normalvariate(bptc.push_waiting_time_mu, bptc.push_waiting_time_sigma), 0))
+            # Process all waiting pushes at once
+            data_strings = [self.q.get()]
+            while True:
+                try:
+                    data_strings.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+
+            if len(data_strings) > 1:
+                self.network.merged_pushes_count += len(data_strings) - 1
+            self.network.process_data_strings(data_strings)
+            for _ in data_strings:
+                self.q.task_done()
 
     def stop(self):
         self._stop_event.set()
@@ -285,20 +544,21 @@ class PushingClientThread(threading.Thread):
         return self._stop_event.is_set()
 
 
-class PushingServerThread(threading.Thread):
-    """Thread responsible for processing the received pushes."""
+class ConsensusThread(threading.Thread):
+    """Thread responsible for calculating the consensus for all events added since its last run."""
 
     def __init__(self, network):
-        super(PushingServerThread, self).__init__()
+        super(ConsensusThread, self).__init__()
         self.network = network
         self._stop_event = threading.Event()
-        self.q = queue.Queue(maxsize=1)
 
     def run(self):
         while not self.stopped():
-            (data_string, peer) = self.q.get()
-            self.network.process_data_string(data_string, peer)
-            self.q.task_done()
+            # The hashgraph is replaced when it is reset
+            hashgraph = self.network.hashgraph
+            if hashgraph.events_added.wait(1):
+                hashgraph.events_added.clear()
+                hashgraph.advance_consensus()
 
     def stop(self):
         self._stop_event.set()
@@ -323,6 +583,16 @@ class BootstrapPushThread(threading.Thread):
             time.sleep(2)
 
 
+def serialize_event(event_id: str, event: Event) -> bytes:
+    """
+    Serializes an event as an entry of the events of a JSON push, see Network.generate_data_string()
+    :param event_id: The hash of the event
+    :param event: The event
+    :return: The serialized entry
+    """
+    return '{}: {}'.format(json.dumps(event_id), json.dumps(event.to_dict())).encode('UTF-8')
+
+
 def filter_members_with_address(members: List[Member]) -> List[Member]:
     """
     Filters a list of members, only returning those who have a known network address
@@ -0,0 +1,180 @@
+import json
+import struct
+from typing import Callable, Dict, List
+from libnacl.encode import base64_encode, base64_decode
+import bptc
+from bptc.data.event import Event, Parents
+from bptc.data.transaction import Transaction
+from bptc.utils.fragment_cache import fragment_cache
+
+"""
+A compact binary format for the messages of the push protocol, used for members with capability BINARY.
+
+Hashes and signatures are sent as raw bytes. The signature of an event is sent without the signed body (events are
+only added to the hashgraph if their signature contains their body) - the receiver serializes the body anyway.
+Verify keys are only sent once per message in a table of creators.
+
+Layout: MAGIC, version (1 byte), length of the header (4 bytes), header (JSON containing the sender, members and the
+table of creators), number of events (4 bytes), events (see _encode_event())
+"""
+
+BINARY = 'binary'
+MAGIC = b'\x00BPB'
+VERSION = 1
+
+HASH_LENGTH = 64
+SIGNATURE_LENGTH = 64
+
+HAS_SELF_PARENT = 1
+HAS_OTHER_PARENT = 2
+HAS_DATA = 4
+
+_uint32 = struct.Struct('>I')
+_uint16 = struct.Struct('>H')
+_event_start = struct.Struct('>{}sHB'.format(HASH_LENGTH))
+
+
+def is_binary_message(data: bytes) -> bool:
+    return data.startswith(MAGIC)
+
+
+def encode_message(sender: Dict, events: Dict[str, Event], members: List[Dict]) -> bytes:
+    """
+    Encodes a message of the push protocol
+    :param sender: The 'from' section of the message
+    :param events: The events to send
+    :param members: The serialized members to send
+    :return: The encoded message
+    """
+    # {member-id => index}: Index of each creator in the table of creators
+    creators = {}
+    encoded_events = []
+    for event in events.values():
+        if event.verify_key not in creators:
+            creators[event.verify_key] = len(creators)
+        encoded_events.append(_encode_event(event, creators[event.verify_key]))
+
+    header = json.dumps({'from': sender, 'members': members, 'creators': list(creators)}).encode('UTF-8')
+    return b''.join([MAGIC, bytes([VERSION]), _uint32.pack(len(header)), header,
+                     _uint32.pack(len(encoded_events))] + encoded_events)
+
+
+def decode_message(data: bytes, knows_event: Callable = None) -> Dict:
+    """
+    Decodes a message created with encode_message()
+    :param data: The message
+    :param knows_event: Known events are skipped without decoding them, see Hashgraph.knows_event() [Optional]
+    :return: Dict containing the sender ('from'), the members ('members'), the unknown events ('events', mapping
+             hashes to events) and the total number of events in the message ('event_count')
+    """
+    if not is_binary_message(data) or data[len(MAGIC)] != VERSION:
+        raise ValueError('Not a binary message of version {}'.format(VERSION))
+
+    offset = len(MAGIC) + 1
+    header_length, = _uint32.unpack_from(data, offset)
+    offset += _uint32.size
+    header = json.loads(data[offset:offset + header_length].decode('UTF-8'))
+    offset += header_length
+    creators = header['creators']
+
+    event_count, = _uint32.unpack_from(data, offset)
+    offset += _uint32.size
+    events = {}
+    for _ in range(event_count):
+        event, offset = _decode_event(data, offset, creators, knows_event, events)
+        if event is not None:
+            events[event.id] = event
+
+    return {'from': header['from'], 'members': header['members'], 'events': events, 'event_count': event_count}
+
+
+def _encode_event(event: Event, creator_index: int) -> bytes:
+    """
+    Encodes an event: hash, index of the creator (2 bytes), flags (1 byte), hashes of the parents (if they exist),
+    time (length as 1 byte and ISO format), transactions (length as 4 bytes and JSON, if there is data) and the
+    signature (without the signed body)
+    Everything except the index of the creator is cached, see fragment_cache.py
+    """
+    fragment = fragment_cache.get((BINARY, event.id), lambda: _encode_event_fragment(event))
+    return b''.join((fragment[:HASH_LENGTH], _uint16.pack(creator_index), fragment[HASH_LENGTH:]))
+
+
+def _encode_event_fragment(event: Event) -> bytes:
+    """Encodes an event like _encode_event(), but without the index of the creator."""
+    flags = 0
+    parts = [None, None]
+    if event.parents.self_parent is not None:
+        flags |= HAS_SELF_PARENT
+        parts.append(base64_decode(event.parents.self_parent.encode('UTF-8')))
+    if event.parents.other_parent is not None:
+        flags |= HAS_OTHER_PARENT
+        parts.append(base64_decode(event.parents.other_parent.encode('UTF-8')))
+
+    time = event.time.encode('UTF-8')
+    parts.append(bytes([len(time)]))
+    parts.append(time)
+
+    if event.data is not None:
+        flags |= HAS_DATA
+        data = json.dumps([x.to_dict() for x in event.data]).encode('UTF-8')
+        parts.append(_uint32.pack(len(data)))
+        parts.append(data)
+
+    parts.append(base64_decode(event.signature.encode('UTF-8'))[:SIGNATURE_LENGTH])
+
+    parts[0] = base64_decode(event.id.encode('UTF-8'))
+    parts[1] = bytes([flags])
+    return b''.join(parts)
+
+
+def _decode_event(data: bytes, offset: int, creators: List[str], knows_event: Callable, new_events: Dict):
+    """
+    Decodes an event encoded with _encode_event(), returning the event (None if it is known) and the new offset. The
+    events decoded before are new
+    """
+    event_hash, creator_index, flags = _event_start.unpack_from(data, offset)
+    offset += _event_start.size
+
+    self_parent = other_parent = None
+    if flags & HAS_SELF_PARENT:
+        self_parent = data[offset:offset + HASH_LENGTH]
+        offset += HASH_LENGTH
+    if flags & HAS_OTHER_PARENT:
+        other_parent = data[offset:offset + HASH_LENGTH]
+        offset += HASH_LENGTH
+
+    time_length = data[offset]
+    time = data[offset + 1:offset + 1 + time_length]
+    offset += 1 + time_length
+
+    transactions = None
+    if flags & HAS_DATA:
+        data_length, = _uint32.unpack_from(data, offset)
+        offset += _uint32.size
+        transactions = data[offset:offset + data_length]
+        offset += data_length
+
+    signature = data[offset:offset + SIGNATURE_LENGTH]
+    offset += SIGNATURE_LENGTH
+
+    event_id = _encode_hash(event_hash)
+    if knows_event is not None and knows_event(event_id, creators[creator_index], _encode_hash(self_parent),
+                                               new_events):
+        return None, offset
+
+    try:
+        if transactions is not None:
+            transactions = [Transaction.from_dict(x) for x in json.loads(transactions.decode('UTF-8'))]
+        event = Event(creators[creator_index], transactions,
+                      Parents(_encode_hash(self_parent), _encode_hash(other_parent)), time.decode('UTF-8'), event_id)
+    except (ValueError, TypeError, KeyError, IndexError, OverflowError):
+        # E.g. a time which can't be parsed - only this event is dropped, it couldn't be valid anyway
+        bptc.logger.warn('Could not decode event {}'.format(event_id[:6]))
+        return None, offset
+    event.signature = base64_encode(signature + event.body_bytes).decode('UTF-8')
+
+    return event, offset
+
+
+def _encode_hash(raw_hash: bytes):
+    return base64_encode(raw_hash).decode('UTF-8') if raw_hash is not None else None
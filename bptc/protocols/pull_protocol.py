@@ -3,7 +3,7 @@ import json
 import zlib
 from math import ceil
 from time import strftime, gmtime
-from twisted.internet import protocol
+from twisted.internet import protocol, threads
 from functools import partial
 import bptc
 from bptc.data.event import Event
@@ -24,13 +24,21 @@ class PullServer(protocol.Protocol):
     """The pull server handles the pulling of a pull client."""
 
     def connectionMade(self):
+        # Serializing all events takes a while - do it outside of the reactor thread and without the lock. Taking the
+        # snapshot waits for the lock, so that happens outside of the reactor thread too
+        d = threads.deferToThread(lambda: self.serialize(self.factory.hashgraph.snapshot()))
+        d.addCallback(self.send)
+        d.addErrback(lambda failure: bptc.logger.error('Pull failed: {}'.format(failure.getErrorMessage())))
+
+    def serialize(self, snapshot):
         serialized_events = {}
-        with self.factory.hashgraph.lock:
-            for event_id, event in self.factory.hashgraph.lookup_table.items():
-                serialized_events[event_id] = event.to_debug_dict()
+        for event in snapshot.events:
+            serialized_events[event.id] = event.to_debug_dict()
 
         data_string = {'from': self.factory.me_id, 'events': serialized_events}
-        data_to_send = zlib.compress(json.dumps(data_string).encode('UTF-8'))
+        return zlib.compress(json.dumps(data_string).encode('UTF-8'))
+
+    def send(self, data_to_send):
         for i in range(1, (ceil(len(data_to_send) / 65536)) + 1):
             self.transport.write(data_to_send[(i-1) * 65536:min(i*65536, len(data_to_send))])
         self.transport.loseConnection()
@@ -90,7 +98,7 @@ class PullClient(protocol.Protocol):
         s_events = received_data['events']
         events = {}
         for event_id, dict_event in s_events.items():
-            events[event_id] = Event.from_debug_dict(dict_event)
+            events[event_id] = Event.from_debug_dict(dict_event, event_id)
 
         try:
             print('Added next tick callback!')
@@ -1,10 +1,19 @@
 from datetime import datetime
-import zlib
 from math import ceil
 from twisted.internet import protocol
+from twisted.protocols.basic import Int32StringReceiver
 import bptc
 
-"""The push protocol is used between two clients for pushing events."""
+"""
+The push protocol is used between two clients for pushing events.
+
+Older versions open a connection for every push, send a single message and close the connection. Clients which know
+that a member supports framing (capability FRAMED) keep a connection open instead: it starts with FRAMED_PREAMBLE,
+followed by any number of messages prefixed with their length.
+"""
+
+FRAMED = 'framed'
+FRAMED_PREAMBLE = b'\x00BPTC/framed\n'
 
 
 class PushServerFactory(protocol.ServerFactory):
@@ -13,60 +22,129 @@ class PushServerFactory(protocol.ServerFactory):
         self.receive_data_string_callback = receive_data_string_callback
         self.allow_reset_signal = allow_reset_signal
         self.protocol = PushServer
-        self.received_data = b""
         self.network = network
 
 
-class PushServer(protocol.Protocol):
+class PushServer(Int32StringReceiver):
     """The push server handles the pushes of a push client."""
 
     def connectionMade(self):
         # Don't call transport.write at this point - all received data might be gone
-        pass
+        # The maximum length of framed and unframed messages
+        self.MAX_LENGTH = bptc.push_max_message_length
+        # Whether the client sends framed messages - None until we know
+        self.framed = None
+        # The data received on this connection (if it isn't framed)
+        self.received_data = b""
+        # Whether the unframed message was too long - the rest of it is ignored
+        self.too_long = False
 
     def dataReceived(self, data):
-        if data[:3] == b'GET':
-            if self.factory.allow_reset_signal and data[4:11] == b'/?reset':
-                self.transport.write('Resetting the local hashgraph!'.encode('UTF-8'))
-                bptc.logger.warn('Deleting local database containing the hashgraph')
-                self.network.reset()
+        if self.too_long:
+            return
+        if self.framed:
+            super().dataReceived(data)
+            return
+
+        if self.framed is None:
+            if len(self.received_data) == 0 and data[:3] == b'GET':
+                if self.factory.allow_reset_signal and data[4:11] == b'/?reset':
+                    self.transport.write('Resetting the local hashgraph!'.encode('UTF-8'))
+                    bptc.logger.warn('Deleting local database containing the hashgraph')
+                    self.network.reset()
+                else:
+                    self.transport.write('I\'m alive!'.encode('UTF-8'))
+                self.transport.loseConnection()
+                return
+
+            self.received_data += data
+            if FRAMED_PREAMBLE.startswith(self.received_data[:len(FRAMED_PREAMBLE)]):
+                if len(self.received_data) < len(FRAMED_PREAMBLE):
+                    return
+                self.framed = True
+                data, self.received_data = self.received_data[len(FRAMED_PREAMBLE):], b""
+                super().dataReceived(data)
             else:
-                self.transport.write('I\'m alive!'.encode('UTF-8'))
-            self.transport.loseConnection()
+                self.framed = False
+                self.check_length()
             return
-        self.factory.received_data += data
+
+        self.received_data += data
+        self.check_length()
+
+    def check_length(self):
+        """Drops an unframed message as soon as it gets too long."""
+        if len(self.received_data) > self.MAX_LENGTH:
+            length, self.received_data = len(self.received_data), b""
+            self.too_long = True
+            self.lengthLimitExceeded(length)
+
+    def stringReceived(self, string):
+        self.process_message(string)
+
+    def lengthLimitExceeded(self, length):
+        bptc.logger.error('Message of length {} is too long - closing the connection'.format(length))
+        self.transport.loseConnection()
 
     def connectionLost(self, reason):
-        if len(self.factory.received_data) == 0:
+        if self.framed or self.too_long:
+            return
+        if len(self.received_data) == 0:
             bptc.logger.warn('No data received!')
             return
-        try:
-            # data = zlib.decompress(self.factory.received_data)
-            data = self.factory.received_data
-            self.factory.receive_data_string_callback(data.decode('UTF-8'), self.transport.getPeer())
-        except zlib.error as err:
-            bptc.logger.error(
-                'Failed parsing input: {}... [length={}] \n\n Error message: {}'.format(
-                    self.factory.received_data[:100], len(self.factory.received_data), err))
-        finally:
-            self.factory.received_data = b""
+        self.process_message(self.received_data)
+        self.received_data = b""
+
+    def process_message(self, message):
+        # The message is decompressed by the thread processing it (see Network.parse_data_string())
+        self.factory.receive_data_string_callback(message, self.transport.getPeer())
 
 
 class PushClientFactory(protocol.ClientFactory):
 
-    def __init__(self, string_to_send, network=None, receiver=None):
+    def __init__(self, string_to_send, network=None, receiver=None, framed=False):
         self.string_to_send = string_to_send
         self.protocol = PushClient
         self.network = network
         self.receiver = receiver
+        # Whether the connection is kept open for sending framed messages, see Network.push_framed()
+        self.framed = framed
+        # The open connection and the address it was made to (framed only)
+        self.connection = None
+        self.receiver_address = (receiver.address.host, receiver.address.port) if framed else None
+        # Whether the connection should be closed as soon as it is made
+        self.closed = False
+
+    def send(self, string_to_send):
+        """
+        Sends a message over the persistent connection. Until the connection is made, only the latest message is kept.
+        :param string_to_send: The message
+        :return: None
+        """
+        if self.connection is not None:
+            self.connection.send_message(string_to_send)
+        else:
+            self.string_to_send = string_to_send
+
+    def close(self):
+        """Closes the persistent connection."""
+        self.closed = True
+        if self.connection is not None:
+            self.connection.transport.loseConnection()
 
     def clientConnectionLost(self, connector, reason):
+        self.forget_connection()
+        if self.framed:
+            # Persistent connections end whenever the other member goes offline - we reconnect with the next push
+            bptc.logger.debug("Connection to {} closed: {}".format(self.receiver, reason.getErrorMessage()))
+            return
         # Ignore failed connections because we expect this to happen
         if reason.getErrorMessage() != 'Connection was closed cleanly.':
             bptc.logger.error("Connection lost: {}".format(reason.getErrorMessage()))
         pass
 
     def clientConnectionFailed(self, connector, reason):
+        self.forget_connection()
         # Count how often a connection to someone failed
         if self.receiver:
             self.receiver.push_fail_count += 1
@@ -74,12 +152,29 @@ class PushClientFactory(protocol.ClientFactory):
                 self.receiver.address = None
                 bptc.logger.debug("Forgot address of {} after three failed attempts".format(self.receiver))
 
+    def forget_connection(self):
+        self.connection = None
+        if self.framed and self.network.push_connections.get(self.receiver.id) is self:
+            del self.network.push_connections[self.receiver.id]
+
 
-class PushClient(protocol.Protocol):
+class PushClient(Int32StringReceiver):
     """The push client pushes to a push server."""
 
     def connectionMade(self):
-        # data_to_send = zlib.compress(self.factory.string_to_send)
+        self.MAX_LENGTH = bptc.push_max_message_length
+        if self.factory.framed:
+            if self.factory.closed:
+                self.transport.loseConnection()
+                return
+            self.transport.write(FRAMED_PREAMBLE)
+            self.factory.connection = self
+            if self.factory.string_to_send is not None:
+                self.send_message(self.factory.string_to_send)
+                self.factory.string_to_send = None
+            return
+
+        # The data was already compressed (see Network.push_to_member)
         data_to_send = self.factory.string_to_send
         for i in range(1, (ceil(len(data_to_send) / 65536)) + 1):
             self.transport.write(data_to_send[(i-1) * 65536:min(i*65536, len(data_to_send))])
@@ -88,5 +183,13 @@ class PushClient(protocol.Protocol):
         if self.factory.network:
             self.factory.network.last_push_sent = datetime.now().isoformat()
 
+    def send_message(self, string_to_send):
+        self.sendString(string_to_send)
+        self.factory.network.last_push_sent = datetime.now().isoformat()
+
+    def stringReceived(self, string):
+        # The server doesn't answer
+        pass
+
     def connectionLost(self, reason):
         pass
@@ -0,0 +1,79 @@
+import lzma
+import zlib
+from typing import List
+import bptc
+
+"""Compresses the messages of the push protocol with a codec the receiver supports."""
+
+# Compressed messages start with a header: the magic bytes, the version of the header and the codec
+# Plain messages (as sent by older versions) are JSON and never start with the magic bytes
+MAGIC = b'\x00BPTC'
+VERSION = 1
+HEADER_LENGTH = len(MAGIC) + 2
+
+UNCOMPRESSED = 0
+ZLIB = 1
+LZMA = 2
+
+# The codecs we can decompress - advertised to other members
+SUPPORTED_CODECS = ['zlib', 'lzma']
+
+
+def compress(data: bytes, codecs: List[str]) -> bytes:
+    """
+    Compresses a message - small messages are only compressed with zlib, big ones with lzma (if supported)
+    :param data: The message
+    :param codecs: The codecs the receiver supports - the message is sent as it is if this is None or empty
+    :return: The message including the header
+    """
+    if not codecs:
+        return data
+
+    if len(data) < bptc.push_compression_min_size:
+        codec, payload = UNCOMPRESSED, data
+    elif len(data) >= bptc.push_lzma_min_size and 'lzma' in codecs:
+        codec, payload = LZMA, lzma.compress(data)
+    elif 'zlib' in codecs:
+        codec, payload = ZLIB, zlib.compress(data)
+    else:
+        codec, payload = UNCOMPRESSED, data
+
+    return MAGIC + bytes([VERSION, codec]) + payload
+
+
+def decompress(data: bytes, max_length: int = None) -> bytes:
+    """
+    Decompresses a message created with compress()
+    :param data: The received message
+    :param max_length: The maximum length of the original message in bytes (None: unlimited) - a ValueError is raised
+                       for longer ones before they are decompressed completely
+    :return: The original message
+    """
+    if not data.startswith(MAGIC):
+        return data
+
+    version, codec = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version != VERSION:
+        raise ValueError('Unsupported message version {}'.format(version))
+
+    payload = data[HEADER_LENGTH:]
+    if codec == UNCOMPRESSED:
+        message, complete = payload, True
+    elif codec == ZLIB:
+        # 0 means unlimited for zlib
+        decompressor = zlib.decompressobj()
+        message = decompressor.decompress(payload, max_length or 0)
+        complete = decompressor.eof
+    elif codec == LZMA:
+        decompressor = lzma.LZMADecompressor()
+        message = decompressor.decompress(payload, -1 if max_length is None else max_length)
+        complete = decompressor.eof
+    else:
+        raise ValueError('Unsupported codec {}'.format(codec))
+
+    # The decompressors stop as soon as max_length bytes are decompressed
+    if max_length is not None and len(message) > max_length or not complete and len(message) == max_length:
+        raise ValueError('The message is longer than {} bytes'.format(max_length))
+    if not complete:
+        raise ValueError('The compressed message is incomplete')
+    return message
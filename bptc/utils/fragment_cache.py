@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+import bptc
+
+"""
+Caches the serialized form of events for the messages of the push protocol.
+
+Events never change once they are signed, so each event only needs to be serialized once - messages are assembled by
+concatenating the cached fragments. The least recently used fragments are dropped once the cache exceeds
+bptc.push_fragment_cache_size bytes.
+"""
+
+
+class FragmentCache:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {key => bytes}: The cached fragments, least recently used first
+        self.fragments = OrderedDict()
+        # int: The total length of all cached fragments
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, serialize: Callable[[], bytes]) -> bytes:
+        """
+        Returns a cached fragment, serializing and caching it if it is not cached yet
+        :param key: The key of the fragment, e.g. the format and the hash of an event
+        :param serialize: Function returning the fragment
+        :return: The fragment
+        """
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        fragment = serialize()
+
+        with self.lock:
+            if key not in self.fragments:
+                self.fragments[key] = fragment
+                self.size += len(fragment)
+                while self.size > bptc.push_fragment_cache_size and self.fragments:
+                    _, dropped = self.fragments.popitem(last=False)
+                    self.size -= len(dropped)
+        return fragment
+
+    def clear(self) -> None:
+        with self.lock:
+            self.fragments.clear()
+            self.size = 0
+
+
+# The cache shared by all message formats
+fragment_cache = FragmentCache()
@@ -0,0 +1,62 @@
+from typing import Iterable, Iterator, List
+
+"""
+A list whose first items can be dropped while the others keep their indexes, e.g. for the chains of events indexed by
+height (see Hashgraph.prune()).
+"""
+
+
+class PrunedList:
+
+    def __init__(self, items: Iterable = (), offset: int = 0):
+        # (int, list): The number of dropped items and the remaining ones. Both are replaced at once when pruning, so
+        # that the list can be read while it is pruned. Items are only appended to the end otherwise.
+        self.__state = (offset, list(items))
+
+    @property
+    def offset(self) -> int:
+        """The number of dropped items - the index of the first remaining one."""
+        return self.__state[0]
+
+    def __len__(self) -> int:
+        offset, items = self.__state
+        return offset + len(items)
+
+    def __iter__(self) -> Iterator:
+        """Iterates over the remaining items."""
+        return iter(self.__state[1])
+
+    def __getitem__(self, index):
+        """
+        Returns an item (None if it was dropped) or the remaining items of a slice - the dropped ones at the beginning
+        of the slice are left out
+        """
+        offset, items = self.__state
+        if isinstance(index, slice):
+            start, stop, step = index.indices(offset + len(items))
+            if step != 1:
+                raise ValueError('Slices of a PrunedList need a step of 1')
+            return items[max(start - offset, 0):max(stop - offset, 0)]
+
+        if index < 0:
+            index += offset + len(items)
+            if index < 0:
+                raise IndexError('PrunedList index out of range')
+        if index < offset:
+            return None
+        return items[index - offset]
+
+    def append(self, item) -> None:
+        self.__state[1].append(item)
+
+    def prune(self, count: int) -> List:
+        """
+        Drops the items before the given index. Items must not be appended meanwhile
+        :param count: The index of the first item to keep
+        :return: The dropped items
+        """
+        offset, items = self.__state
+        if count <= offset:
+            return []
+        self.__state = (count, items[count - offset:])
+        return items[:count - offset]
@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+from libnacl import crypto_sign_open
+from libnacl.encode import base64_decode
+import bptc
+
+"""Verifies signatures - big batches are verified in parallel by a pool of processes."""
+
+# The pool is created on first use
+_pool = None
+_pool_processes = 0
+_pool_lock = threading.Lock()
+_pool_unavailable = False
+
+
+def verify_signature(signature: str, verify_key: str, message: bytes) -> bool:
+    """
+    Checks whether a signature was created by the given verify key and contains the given message
+    :param signature: The base64 encoded signature (containing the signed message)
+    :param verify_key: The base64 encoded verify key
+    :param message: The message that was supposedly signed (encoded)
+    :return: bool
+    """
+    if signature is None:
+        return False
+    signature_byte = base64_decode(signature.encode("UTF-8"))
+    verify_key_byte = base64_decode(verify_key.encode("UTF-8"))
+    try:
+        return crypto_sign_open(signature_byte, verify_key_byte) == message
+    except ValueError:
+        return False
+
+
+def _verify_chunk(chunk: List[Tuple[str, str, bytes]]) -> List[bool]:
+    return [verify_signature(*item) for item in chunk]
+
+
+def _get_pool():
+    """Returns the process pool or None if it is disabled or can't be used on this platform."""
+    global _pool, _pool_processes, _pool_unavailable
+    with _pool_lock:
+        if _pool is None and not _pool_unavailable:
+            processes = bptc.signature_verification_processes or os.cpu_count() or 1
+            if processes < 2:
+                _pool_unavailable = True
+                return None
+            if sys.version_info < (3, 7):
+                # The pool could only fork the processes before Python 3.7 (no mp_context)
+                bptc.logger.warn('Verifying signatures in a single process: Python 3.7 is needed for the pool')
+                _pool_unavailable = True
+                return None
+            try:
+                # Don't fork - the parent process is running the reactor and other threads
+                _pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+                _pool_processes = processes
+            except (ImportError, NotImplementedError, OSError, ValueError) as e:
+                bptc.logger.warn('Verifying signatures in a single process: {}'.format(e))
+                _pool_unavailable = True
+        return _pool
+
+
+def verify_signatures(items: List[Tuple[str, str, bytes]]) -> List[bool]:
+    """
+    Verifies many signatures at once, see verify_signature()
+    :param items: List of (signature, verify key, message) tuples
+    :return: For every item, whether its signature is valid
+    """
+    pool = None
+    if len(items) >= bptc.signature_verification_pool_threshold:
+        pool = _get_pool()
+    if pool is None:
+        return _verify_chunk(items)
+
+    # Some chunks per process, so that the processes stay busy until the end
+    chunk_size = max(1, len(items) // (_pool_processes * 4))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    try:
+        return [valid for result in pool.map(_verify_chunk, chunks) for valid in result]
+    except Exception as e:
+        # e.g. a broken pool - don't use it again, verifying in this process always works
+        bptc.logger.warn('Verifying signatures in parallel failed: {}'.format(e))
+        _disable_pool()
+        return _verify_chunk(items)
+
+
+def _disable_pool():
+    global _pool, _pool_unavailable
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+        _pool_unavailable = True
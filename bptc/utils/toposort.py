@@ -1,19 +1,32 @@
-from toposort import toposort_flatten
-
-
 def toposort(events):
-    """Return a topological sorted list of events."""
-    graph = {}
+    """
+    Return a topological sorted list of events.
+    Events are sorted level by level (parents are always in a lower level) and by hash within a level. Raises a
+    ValueError if the parents contain a cycle.
+    """
+    # {event-hash => number of parents in events which are not sorted yet}
+    unsorted_parents_count = {}
+    # {event-hash => [event-hash]}: The children of each event in events
+    children = {event_id: [] for event_id in events}
     for event_id, event in events.items():
-        if event.parents.self_parent in events:
-            self_parent = event.parents.self_parent
-        else:
-            self_parent = None
-        if event.parents.other_parent in events:
-            other_parent = event.parents.other_parent
-        else:
-            other_parent = None
-        parents = set([self_parent, other_parent])
-        graph[event.id] = parents - set([None])  # Remove empty entries
+        parents = set(parent_id for parent_id in event.parents if parent_id in events)
+        unsorted_parents_count[event_id] = len(parents)
+        for parent_id in parents:
+            children[parent_id].append(event_id)
+
+    result = []
+    level = sorted(event_id for event_id, count in unsorted_parents_count.items() if count == 0)
+    while level:
+        result.extend(level)
+        next_level = []
+        for event_id in level:
+            for child_id in children[event_id]:
+                unsorted_parents_count[child_id] -= 1
+                if unsorted_parents_count[child_id] == 0:
+                    next_level.append(child_id)
+        level = sorted(next_level)
+
+    if len(result) != len(events):
+        raise ValueError('Circular parents in {} events'.format(len(events) - len(result)))
 
-    return [events[event_id] for event_id in toposort_flatten(graph)]
+    return [events[event_id] for event_id in result]
@@ -36,7 +36,7 @@ version.filename = %(source.dir)s/main.py
 
 # (list) Application requirements
 # comma seperated e.g. requirements = sqlite3,kivy
-requirements = python3crystax,kivy,twisted,libnacl,toposort,dateutil,cachetools,bokeh==0.12.6,Pillow==4.1.1,prompt-toolkit==1.0.14,py-dateutil==2.2,toposort==1.5,Twisted==17.1.0.,service_identity==17.0.0,python-dateutil==2.6.0,pygame>=1.9
+requirements = python3crystax,kivy,twisted,libnacl,dateutil,cachetools,bokeh==0.12.6,Pillow==4.1.1,prompt-toolkit==1.0.14,py-dateutil==2.2,Twisted==17.1.0.,service_identity==17.0.0,python-dateutil==2.6.0,pygame>=1.9
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from generate import generate_hashgraph, init_benchmark_logger
+import bptc
+from bptc.data.db import DB
+
+"""
+Measures how long it takes to save a hashgraph to the database, to store a few changed events in the background (see
+DB.flush()) and to load the hashgraph again - from the stored checkpoint and without it (see DB.load_hashgraph()).
+The storage profile can be changed for comparing it with SQLite's defaults (-j DELETE -s FULL).
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--members', type=int, default=8, help='Number of members creating events')
+    parser.add_argument('-e', '--events', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='Number of events in the hashgraph')
+    parser.add_argument('-f', '--flush', type=int, default=100, help='Number of changed events per flush')
+    parser.add_argument('-j', '--journal-mode', default=bptc.db_journal_mode, help='PRAGMA journal_mode')
+    parser.add_argument('-s', '--synchronous', default=bptc.db_synchronous, help='PRAGMA synchronous')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    init_benchmark_logger()
+    bptc.db_journal_mode = args.journal_mode
+    bptc.db_synchronous = args.synchronous
+
+    print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('events', 'save s', 'flush ms', 'load s', 'full s', 'MB'))
+    with tempfile.TemporaryDirectory() as directory:
+        for event_count in args.events:
+            hashgraph = generate_hashgraph(args.members, event_count)
+            hashgraph.advance_consensus()
+            # Only the own member has its signing key, like in a real database
+            for member in hashgraph.known_members.values():
+                if member is not hashgraph.me:
+                    member.signing_key = None
+
+            database_file = os.path.join(directory, 'data{}.db'.format(event_count))
+            DB.load_hashgraph(database_file)
+
+            start = time.perf_counter()
+            DB.save(hashgraph)
+            save_time = time.perf_counter() - start
+
+            flush_times = []
+            event_ids = list(hashgraph.lookup_table.resident)
+            for _ in range(20):
+                hashgraph.dirty_events = set(random.sample(event_ids, args.flush))
+                start = time.perf_counter()
+                DB.flush(hashgraph)
+                flush_times.append(time.perf_counter() - start)
+            DB.close()
+            del hashgraph
+
+            start = time.perf_counter()
+            DB.load_hashgraph(database_file)
+            load_time = time.perf_counter() - start
+            DB.close()
+
+            # Verify and replay all events
+            connection = sqlite3.connect(database_file)
+            connection.execute('DELETE FROM checkpoint')
+            connection.commit()
+            connection.close()
+            start = time.perf_counter()
+            DB.load_hashgraph(database_file)
+            full_load_time = time.perf_counter() - start
+            DB.close()
+
+            print('{:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f}'.format(
+                event_count, save_time, sum(flush_times) / len(flush_times) * 1000, load_time, full_load_time,
+                os.path.getsize(database_file) / 2 ** 20))
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+from generate import generate_hashgraph, init_benchmark_logger
+import bptc
+from bptc.data.db import DB
+from bptc.data.event import Event
+from bptc.data.hashgraph import Hashgraph
+
+"""
+Measures how many events a hashgraph keeps in memory while it grows (see EventStore and Hashgraph.prune()): the events
+of a generated hashgraph are added again one by one, calculating the consensus and storing the changes regularly like a
+running node. The memory should stop growing once events are archived. Compare with a horizon that is never reached
+(-r 1000000000) for the memory needed without evicting events.
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--members', type=int, default=8, help='Number of members creating events')
+    parser.add_argument('-e', '--events', type=int, default=50000, help='Number of events in the hashgraph')
+    parser.add_argument('-f', '--flush', type=int, default=500, help='Number of added events per flush')
+    parser.add_argument('-p', '--print', type=int, default=10000, help='Number of added events per printed line')
+    parser.add_argument('-r', '--horizon', type=int, default=bptc.event_horizon_rounds,
+                        help='Rounds after which ordered events are evicted')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    init_benchmark_logger()
+    bptc.event_horizon_rounds = args.horizon
+
+    generated = generate_hashgraph(args.members, args.events)
+    me = generated.me
+    members = list(generated.known_members.values())
+    rows = [generated.lookup_table[event_id].to_db_tuple() for event_id in generated.events]
+    del generated
+    gc.collect()
+
+    print('{:>8} {:>10} {:>10} {:>10} {:>10}'.format('events', 'resident', 'archived', 'MB', 'total s'))
+    with tempfile.TemporaryDirectory() as directory:
+        DB.load_hashgraph(os.path.join(directory, 'data.db'))
+        tracemalloc.start()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+
+        hashgraph = Hashgraph(me)
+        for member in members:
+            member.head = None
+            hashgraph.known_members[member.id] = member
+        for i, row in enumerate(rows, 1):
+            hashgraph.add_event(Event.from_db_tuple(row))
+            if i % args.flush == 0:
+                hashgraph.advance_consensus()
+                DB.flush(hashgraph)
+            if i % args.print == 0:
+                gc.collect()
+                print('{:>8} {:>10} {:>10} {:>10.1f} {:>10.2f}'.format(
+                    i, len(hashgraph.lookup_table.resident), hashgraph.lookup_table.evicted_count,
+                    (tracemalloc.get_traced_memory()[0] - start_memory) / 2 ** 20, time.perf_counter() - start))
+        DB.close()
@@ -0,0 +1,54 @@
+import logging
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import bptc
+from bptc.data.event import Event, Parents
+from bptc.data.hashgraph import Hashgraph
+from bptc.data.member import Member
+from bptc.data.transaction import MoneyTransaction
+
+"""Generates hashgraphs with signed events for the benchmarks."""
+
+
+def init_benchmark_logger():
+    bptc.logger = logging.getLogger('benchmark')
+    bptc.logger.addHandler(logging.NullHandler())
+
+
+def generate_hashgraph(member_count: int, event_count: int, seed: int = 0, transaction_rate: float = 0.1) -> Hashgraph:
+    """
+    Generates a hashgraph by letting members gossip with random other members
+    The consensus is not calculated
+    :param member_count: The number of members creating events
+    :param event_count: The number of events to create
+    :param seed: Seed for choosing the members
+    :param transaction_rate: The share of events containing a transaction
+    :return: The hashgraph of the first member, containing all events
+    """
+    rng = random.Random(seed)
+    members = [Member.create() for _ in range(member_count)]
+    hashgraph = Hashgraph(members[0])
+    for member in members:
+        member.stake = 1
+        hashgraph.known_members[member.id] = member
+
+    def add_event(member, other_parent, data=None):
+        event = Event(member.verify_key, data, Parents(member.head, other_parent))
+        event.sign(member.signing_key)
+        hashgraph.add_event(event)
+
+    for member in members:
+        add_event(member, None)
+
+    while len(hashgraph.lookup_table) < event_count:
+        member, other = rng.sample(members, 2)
+        data = None
+        if rng.random() < transaction_rate:
+            data = [MoneyTransaction(other.verify_key, rng.randint(1, 10), 'Benchmark')]
+        add_event(member, other.head, data)
+
+    return hashgraph
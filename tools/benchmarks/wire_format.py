@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import time
+import zlib
+from twisted.internet.address import IPv4Address
+from generate import generate_hashgraph, init_benchmark_logger
+from bptc.data.event import Event
+from bptc.data.network import Network
+from bptc.protocols.binary_format import decode_message
+from bptc.utils.fragment_cache import fragment_cache
+
+"""
+Compares size and speed of the JSON and the binary format of pushes (see bptc/protocols/binary_format.py).
+Encoding is measured with an empty cache of serialized events and with all events cached (see fragment_cache.py).
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--members', type=int, default=8, help='Number of members creating events')
+    parser.add_argument('-e', '--events', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='Number of events per push')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Repetitions of each measurement (best is used)')
+    return parser.parse_args()
+
+
+def measure(function, repeat):
+    """Returns the result and the best time in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        duration = (time.perf_counter() - start) * 1000
+        best = duration if best is None else min(best, duration)
+    return result, best
+
+
+def decode_json(data):
+    received_data = json.loads(data)
+    events = {event_id: Event.from_dict(dict_event, event_id) for event_id, dict_event in received_data['events'].items()}
+    # The body is needed for checking the ID and signature of received events
+    for event in events.values():
+        event.body_bytes
+    return events
+
+
+def decode_binary(data):
+    # The binary format needs the body anyway to restore the signature
+    return decode_message(data)['events']
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    init_benchmark_logger()
+
+    hashgraph = generate_hashgraph(args.members, max(args.events))
+    hashgraph.me.address = IPv4Address('TCP', '127.0.0.1', 8000)
+    heights = hashgraph.get_known_heights()
+    event_ids = list(hashgraph.events)
+
+    print('{:>7} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('events', 'format', 'bytes', 'zlib', 'encode ms',
+                                                                  'cached ms', 'decode ms'))
+    for event_count in args.events:
+        events = {event_id: hashgraph.lookup_table[event_id] for event_id in event_ids[-event_count:]}
+        for name, binary, decode in (('json', False, decode_json), ('binary', True, decode_binary)):
+            def encode():
+                return Network.generate_data_string(hashgraph.me, events, [], heights, binary)
+
+            def encode_uncached():
+                fragment_cache.clear()
+                return encode()
+
+            data, encode_time = measure(encode_uncached, args.repeat)
+            _, cached_encode_time = measure(encode, args.repeat)
+            _, decode_time = measure(lambda: decode(data), args.repeat)
+            print('{:>7} {:>7} {:>10} {:>10} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                event_count, name, len(data), len(zlib.compress(data)), encode_time, cached_encode_time, decode_time))